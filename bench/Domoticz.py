@@ -0,0 +1,147 @@
+# Stand-in for the Domoticz python plugin module, so the plugin can run off a live Domoticz
+# Only implements what Tasmoticz uses. Counts Create() and Update() calls for benchmark.py
+
+
+import time
+
+
+Devices = {}
+
+# Call counters of interest for benchmarks
+counters = {'Create': 0, 'Update': 0, 'Send': 0}
+
+# Log messages (level, text), only kept if keepLog is set
+log = []
+keepLog = False
+debugging = 0
+
+
+# TypeName -> (Type, SubType, SwitchType) as in maptypename() of domoticz PythonObjects.cpp
+typeNames = {
+    'Switch':           (244, 73, 0),
+    'Temperature':      (80, 5, 0),
+    'Humidity':         (81, 1, 0),
+    'Temp+Hum':         (82, 1, 0),
+    'Temp+Hum+Baro':    (84, 1, 0),
+    'Current/Ampere':   (89, 1, 0),
+    'Barometer':        (243, 26, 0),
+    'Distance':         (243, 27, 0),
+    'Custom':           (243, 31, 0),
+    'Voltage':          (243, 8, 0),
+    'Current (Single)': (243, 23, 0),
+    'Text':             (243, 19, 0),
+    'Illumination':     (246, 1, 0),
+    'Usage':            (248, 1, 0),
+}
+
+_configuration = {}
+
+
+def _log(level, msg):
+    if keepLog:
+        log.append((level, msg))
+
+
+def Debug(msg):
+    if debugging:
+        _log('Debug', msg)
+
+
+def Log(msg):
+    _log('Log', msg)
+
+
+def Status(msg):
+    _log('Status', msg)
+
+
+def Error(msg):
+    _log('Error', msg)
+
+
+def Debugging(mask):
+    global debugging
+    debugging = mask
+
+
+def Heartbeat(seconds):
+    pass
+
+
+def Configuration(config=None):
+    global _configuration
+    if config is not None:
+        _configuration = dict(config)
+    return dict(_configuration)
+
+
+class Device:
+    def __init__(self, Name='', Unit=0, TypeName='', Type=0, Subtype=0, Switchtype=0, Used=0,
+                 Options=None, Description='', DeviceID='', Image=0):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        if TypeName:
+            self.Type, self.SubType, self.SwitchType = typeNames[TypeName]
+        else:
+            self.Type, self.SubType, self.SwitchType = Type, Subtype, Switchtype
+        self.Used = Used
+        self.Options = Options if Options is not None else {}
+        self.Description = Description
+        self.DeviceID = DeviceID
+        self.Image = Image
+        self.nValue = 0
+        self.sValue = ''
+        self.LastUpdate = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def Create(self):
+        counters['Create'] += 1
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=None, sValue=None, SuppressTriggers=False, **kwargs):
+        counters['Update'] += 1
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self.LastUpdate = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def __str__(self):
+        return "Unit: {}, Name: '{}', nValue: {}, sValue: '{}'".format(self.Unit, self.Name, self.nValue, self.sValue)
+
+
+class Connection:
+    def __init__(self, Name='', Transport='', Protocol='', Address='', Port=''):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.sent = []
+        self.keepSent = False
+        self._connected = False
+
+    def Connect(self):
+        self._connected = True
+
+    def Connected(self):
+        return self._connected
+
+    def Connecting(self):
+        return False
+
+    def Send(self, data):
+        counters['Send'] += 1
+        if self.keepSent:
+            self.sent.append(data)
+
+    def Disconnect(self):
+        self._connected = False
+
+    def __str__(self):
+        return "Connection: {}:{}".format(self.Address, self.Port)
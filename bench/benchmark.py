@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Throughput benchmark of the whole plugin without a live Domoticz
+#
+# Uses the stand-in Domoticz module next to this file and drives
+# plugin.onMessage() -> MqttClient.onMessage() -> Handler.onMQTTPublish()
+# with generated Tasmota traffic of a fleet of devices with sensors.
+#
+# Usage: python3 bench/benchmark.py [--devices N] [--sensors M] [--rounds R] [--settings tasmoticz.json]
+
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+import Domoticz  # noqa: E402 (the stand-in)
+import plugin  # noqa: E402
+
+
+# Sensor kinds with their starting values. Sensors beyond these are DS18B20-n temperatures
+sensorKinds = [
+    ('AM2301', {'Temperature': 21.0, 'Humidity': 50.0}),
+    ('BME280', {'Temperature': 20.0, 'Humidity': 45.0, 'Pressure': 1013.0}),
+    ('ENERGY', {'Total': 12.345, 'Yesterday': 1.1, 'Today': 0.5, 'Power': 60.0,
+                'Voltage': 230.0, 'Current': 0.26, 'Factor': 0.95}),
+    ('TSL2561', {'Illuminance': 300.0}),
+]
+
+
+class Fleet:
+    def __init__(self, devices, sensors, rng):
+        self.rng = rng
+        self.devices = []
+        for d in range(devices):
+            values = {}
+            for s in range(sensors):
+                if s < len(sensorKinds):
+                    name, start = sensorKinds[s]
+                    values[name] = dict(start)
+                else:
+                    values['DS18B20-{}'.format(s - len(sensorKinds) + 1)] = {'Temperature': 18.0}
+            self.devices.append({'topic': 'bench{}'.format(d), 'power': 'OFF', 'values': values})
+
+    # Random walk of all sensor values, rounded like tasmota does
+    def step(self):
+        for device in self.devices:
+            for values in device['values'].values():
+                for key, value in values.items():
+                    if key == 'Total':
+                        values[key] = round(value + self.rng.random() * 0.001, 3)
+                    else:
+                        values[key] = round(value + self.rng.uniform(-0.5, 0.5) * max(abs(value) * 0.01, 0.1), 1)
+
+    def info1(self, device):
+        return 'tele/{}/INFO1'.format(device['topic']), {'Module': 'Sonoff Pow R2', 'Version': '9.1.0', 'FallbackTopic': 'DVES'}
+
+    def state(self, device):
+        return 'tele/{}/STATE'.format(device['topic']), {
+            'Time': '2020-01-01T00:00:00', 'Uptime': '0T01:00:00', 'Heap': 25, 'LoadAvg': 19,
+            'POWER': device['power'], 'Wifi': {'AP': 1, 'SSId': 'bench', 'RSSI': 70}}
+
+    def sensor(self, device):
+        message = {'Time': '2020-01-01T00:00:00', 'TempUnit': 'C'}
+        message.update(device['values'])
+        return 'tele/{}/SENSOR'.format(device['topic']), message
+
+    def result(self, device):
+        device['power'] = 'ON' if device['power'] == 'OFF' else 'OFF'
+        return 'stat/{}/RESULT'.format(device['topic']), {'POWER': device['power']}
+
+    def status(self, device):
+        return 'stat/{}/STATUS'.format(device['topic']), {'Status': {
+            'Module': 43, 'FriendlyName': [device['topic'].capitalize()], 'Topic': device['topic'], 'Power': 0}}
+
+    # Traffic the plugin has to ignore
+    def noise(self, device):
+        return self.rng.choice([
+            ('tele/{}/LWT'.format(device['topic']), 'Online'),
+            ('tele/{}/UPTIME'.format(device['topic']), {'Uptime': '0T01:00:00'}),
+            ('stat/{}/STATUS11'.format(device['topic']), {'StatusSTS': {'Heap': 25}}),
+            ('zigbee2mqtt/{}'.format(device['topic']), {'temperature': 20}),
+        ])
+
+
+class Bench:
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        self.connection = None
+        self.latencies = {}
+        self.messages = 0
+
+    def start(self, home):
+        plugin.Parameters = {
+            'Address': 'localhost', 'Port': '1883', 'Username': '', 'Password': '', 'HomeFolder': home,
+            'Mode1': 'cmnd', 'Mode2': 'stat', 'Mode3': 'tele', 'Mode4': '%prefix%/%topic%|%topic%/%prefix%',
+            'Mode5': 'bench', 'Mode6': 'Normal'}
+        plugin.Devices = Domoticz.Devices
+        plugin.onStart()
+        self.connection = plugin._plugin.mqttClient._connection
+        plugin.onConnect(self.connection, 0, '')
+        plugin.onMessage(self.connection, {'Verb': 'CONNACK', 'Status': 0})
+
+    def send(self, topic, message):
+        payload = message if isinstance(message, str) else json.dumps(message)
+        data = {'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload.encode('utf8'), 'QoS': 0}
+        tail = topic.rpartition('/')[2] if topic.startswith(('tele/', 'stat/')) else 'foreign'
+        start = time.perf_counter()
+        plugin.onMessage(self.connection, data)
+        self.latencies.setdefault(tail, []).append(time.perf_counter() - start)
+        self.messages += 1
+        if self.messages % self.heartbeat == 0:
+            self.onHeartbeat()
+
+    # Each call stands for a 10s heartbeat, so the plugin must not skip it as too early
+    def onHeartbeat(self):
+        plugin._plugin.heartbeatNext = 0
+        plugin.onHeartbeat()
+
+    def phase(self, name, messages):
+        self.latencies = {}
+        before = dict(Domoticz.counters)
+        start = time.perf_counter()
+        for topic, message in messages:
+            self.send(topic, message)
+        if plugin._plugin.pipeline is not None:
+            plugin._plugin.pipeline.join()
+        self.onHeartbeat()
+        elapsed = time.perf_counter() - start
+        count = sum(len(latencies) for latencies in self.latencies.values())
+        print('{}: {} messages in {:.3f}s, {:.0f} messages/s'.format(name, count, elapsed, count / elapsed if elapsed else 0))
+        print('  {:10} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('tail', 'count', 'p50 us', 'p90 us', 'p99 us', 'max us'))
+        for tail, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            print('  {:10} {:8} {:9.1f} {:9.1f} {:9.1f} {:9.1f}'.format(
+                tail, len(latencies), percentile(latencies, 50), percentile(latencies, 90),
+                percentile(latencies, 99), latencies[-1] * 1e6))
+        print('  ' + ', '.join('{}(): {}'.format(key, Domoticz.counters[key] - before[key]) for key in sorted(before)))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tasmoticz throughput benchmark')
+    parser.add_argument('--devices', type=int, default=30, help='number of tasmota devices')
+    parser.add_argument('--sensors', type=int, default=3, help='sensors per device')
+    parser.add_argument('--rounds', type=int, default=20, help='telemetry rounds after boot')
+    parser.add_argument('--heartbeat', type=int, default=1000, help='messages between onHeartbeat() calls')
+    parser.add_argument('--settings', help='tasmoticz.json to use')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='tasmoticz-bench-')
+    try:
+        if args.settings:
+            shutil.copy(args.settings, os.path.join(home, 'tasmoticz.json'))
+        fleet = Fleet(args.devices, args.sensors, random.Random(args.seed))
+        bench = Bench(args.heartbeat)
+        bench.start(home)
+
+        boot = []
+        for device in fleet.devices:
+            boot += [fleet.info1(device), fleet.state(device), fleet.sensor(device), fleet.status(device)]
+        bench.phase('boot', boot)
+
+        def telemetry():
+            rng = fleet.rng
+            for _ in range(args.rounds):
+                fleet.step()
+                for device in fleet.devices:
+                    yield fleet.state(device)
+                    yield fleet.sensor(device)
+                    if rng.random() < 0.1:
+                        yield fleet.result(device)
+                    if rng.random() < 0.5:
+                        yield fleet.noise(device)
+        bench.phase('telemetry', telemetry())
+        print('units: {}'.format(len(Domoticz.Devices)))
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
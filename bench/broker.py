@@ -0,0 +1,152 @@
+# Minimal in-process MQTT 3.1.1 broker for transport benchmarks
+# QoS 0 (QoS 1 PUBLISHes are acknowledged but delivered as QoS 0), + and # wildcards, no retained messages
+
+
+import selectors
+import socket
+import threading
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqttsocket  # noqa: E402
+from mqttsocket import Parser, decodeString  # noqa: E402
+
+
+def topicMatches(subscription, topic):
+    patterns = subscription.split('/')
+    levels = topic.split('/')
+    for i, pattern in enumerate(patterns):
+        if pattern == '#':
+            return True
+        if i >= len(levels) or (pattern != '+' and pattern != levels[i]):
+            return False
+    return len(patterns) == len(levels)
+
+
+class Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = Parser()
+        self.out = bytearray()
+        self.subscriptions = set()
+
+
+class Broker:
+    def __init__(self, address='127.0.0.1', port=0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((address, port))
+        self.server.listen(16)
+        self.server.setblocking(False)
+        self.address, self.port = self.server.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.clients = {}
+        self.received = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name='broker', daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2)
+        for client in list(self.clients.values()):
+            self.drop(client)
+        self.selector.close()
+        self.server.close()
+
+    def serve(self):
+        while self.running:
+            for key, events in self.selector.select(0.05):
+                if key.fileobj is self.server:
+                    sock, _ = self.server.accept()
+                    sock.setblocking(False)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    client = Client(sock)
+                    self.clients[sock] = client
+                    self.selector.register(sock, selectors.EVENT_READ)
+                    continue
+                client = self.clients.get(key.fileobj)
+                if client is None:
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.read(client)
+                if events & selectors.EVENT_WRITE and client.sock in self.clients:
+                    self.write(client)
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+        for type, flags, body in client.parser.feed(data):
+            self.handle(client, type, flags, body)
+
+    def handle(self, client, type, flags, body):
+        if type == mqttsocket.CONNECT:
+            self.send(client, mqttsocket.connackPacket(False, 0))
+        elif type == mqttsocket.SUBSCRIBE:
+            packetId = int.from_bytes(body[:2], 'big')
+            pos = 2
+            qoss = []
+            while pos < len(body):
+                topic, pos = decodeString(body, pos)
+                client.subscriptions.add(topic.decode('utf8'))
+                qoss.append(0)
+                pos += 1
+            self.send(client, mqttsocket.subackPacket(packetId, qoss))
+        elif type == mqttsocket.UNSUBSCRIBE:
+            packetId = int.from_bytes(body[:2], 'big')
+            pos = 2
+            while pos < len(body):
+                topic, pos = decodeString(body, pos)
+                client.subscriptions.discard(topic.decode('utf8'))
+            self.send(client, mqttsocket.unsubackPacket(packetId))
+        elif type == mqttsocket.PUBLISH:
+            self.received += 1
+            data = mqttsocket.packetData(type, flags, body)
+            if data['QoS'] == 1:
+                self.send(client, mqttsocket.pubackPacket(data['PacketIdentifier']))
+            forward = mqttsocket.publishPacket(data['Topic'], data['Payload'])
+            for other in list(self.clients.values()):
+                if any(topicMatches(subscription, data['Topic']) for subscription in other.subscriptions):
+                    self.send(other, forward)
+        elif type == mqttsocket.PINGREQ:
+            self.send(client, mqttsocket.PINGRESP_PACKET)
+        elif type == mqttsocket.DISCONNECT:
+            self.drop(client)
+
+    def send(self, client, data):
+        if not client.out:
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        client.out += data
+
+    def write(self, client):
+        try:
+            sent = client.sock.send(client.out)
+            del client.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.drop(client)
+            return
+        if not client.out:
+            self.selector.modify(client.sock, selectors.EVENT_READ)
+
+    def drop(self, client):
+        if self.clients.pop(client.sock, None) is not None:
+            self.selector.unregister(client.sock)
+            client.sock.close()
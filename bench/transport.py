@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Throughput benchmark of the pure python mqtt transport (mqttsocket) of MqttClient
+#
+# Starts the in-process broker of broker.py, connects a subscribing MqttClient with transport "socket"
+# and a publishing one, then measures how fast pipelined PUBLISHes get through.
+#
+# Usage: python3 bench/transport.py [--messages N] [--payload BYTES] [--batch N]
+
+
+import argparse
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+import Domoticz  # noqa: E402,F401 (the stand-in, mqtt.py needs it for logging)
+from mqtt import MqttClient  # noqa: E402
+from broker import Broker  # noqa: E402
+
+
+def connect(port, client_id, on_message=None, on_subscribed=None):
+    state = {'connected': False}
+
+    def connected():
+        state['connected'] = True
+    client = MqttClient('127.0.0.1', str(port), client_id, connected, lambda: None,
+                        on_message or (lambda topic, message: None), on_subscribed or (lambda: None), transport='socket')
+    deadline = time.monotonic() + 5
+    while not state['connected']:
+        if time.monotonic() > deadline:
+            raise RuntimeError('no CONNACK from broker')
+        client.poll(0.01)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tasmoticz mqtt socket transport benchmark')
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--payload', type=int, default=200, help='payload bytes')
+    parser.add_argument('--batch', type=int, default=100, help='publishes between polls of the publisher')
+    args = parser.parse_args()
+
+    broker = Broker()
+    port = broker.start()
+    try:
+        received = [0]
+        subscribed = [False]
+
+        def on_message(topic, message):
+            received[0] += 1
+
+        def on_subscribed():
+            subscribed[0] = True
+
+        subscriber = connect(port, 'bench-sub', on_message, on_subscribed)
+        subscriber.subscribe(['tele/+/SENSOR', 'stat/+/RESULT'])
+        while not subscribed[0]:
+            subscriber.poll(0.01)
+
+        publisher = connect(port, 'bench-pub')
+        payload = '{"ENERGY":{"Power":' + '1' * max(args.payload - 20, 1) + '}}'
+        start = time.perf_counter()
+        for n in range(args.messages):
+            publisher.publish('tele/bench{}/SENSOR'.format(n % 100), payload)
+            if n % args.batch == 0:
+                publisher.poll(0)
+                subscriber.poll(0)
+        while received[0] < args.messages:
+            publisher.poll(0)
+            subscriber.poll(0.01)
+            if time.perf_counter() - start > 60:
+                break
+        elapsed = time.perf_counter() - start
+        print('{} of {} messages of {} bytes in {:.3f}s: {:.0f} messages/s'.format(
+            received[0], args.messages, len(payload), elapsed, received[0] / elapsed))
+        publisher.close()
+        subscriber.close()
+    finally:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
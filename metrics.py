@@ -0,0 +1,115 @@
+# Runtime metrics of the plugin: counters and latency histograms
+# Collected always (cheap), published from Plugin.onHeartbeat as prometheus textfile and log summary
+# Not locked: with worker threads a count can get lost now and then
+
+
+import os
+import time
+from bisect import bisect_left
+
+
+# Known metrics: name -> (prometheus type, help, label name or None)
+metricInfo = {
+    'tasmoticz_mqtt_packets_total':        ('counter', 'MQTT packets received by verb', 'verb'),
+    'tasmoticz_mqtt_filtered_total':       ('counter', 'PUBLISH packets dropped undecoded by topic filter', None),
+    'tasmoticz_mqtt_decode_failures_total': ('counter', 'PUBLISH payloads that could not be decoded', None),
+    'tasmoticz_mqtt_message_seconds':      ('histogram', 'Processing time of PUBLISH packets in MqttClient', None),
+    'tasmoticz_messages_total':            ('counter', 'Tasmota messages processed by topic tail', 'tail'),
+    'tasmoticz_unmatched_total':           ('counter', 'Messages not matching a subscription pattern', None),
+    'tasmoticz_message_seconds':           ('histogram', 'Processing time of tasmota messages by topic tail', 'tail'),
+    'tasmoticz_updates_total':             ('counter', 'Domoticz device value writes', None),
+    'tasmoticz_updates_suppressed_total':  ('counter', 'Value updates not written by reason', 'reason'),
+    'tasmoticz_keepalives_total':          ('counter', 'Unchanged values rewritten to keep domoticz devices alive', None),
+    'tasmoticz_devices_created_total':     ('counter', 'Domoticz devices created', None),
+    'tasmoticz_commands_total':            ('counter', 'Domoticz commands published directly, batched by CommandWindow or to a group', 'mode'),
+    'tasmoticz_commands_unconfirmed_total': ('counter', 'Optimistic commands without confirmation in time by outcome', 'outcome'),
+    'tasmoticz_teleperiod_changes_total':  ('counter', 'TelePeriod commands by direction', 'direction'),
+    'tasmoticz_pipeline_dropped_total':    ('counter', 'Packets dropped by full worker queue by drop policy', 'policy'),
+}
+
+# Upper bounds of latency histogram buckets in seconds
+buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# (name, label value) -> count
+counters = {}
+# (name, label value) -> [count per bucket..., count above last bucket, sum of seconds]
+histograms = {}
+
+started = time.monotonic()
+summarized = (started, 0)
+
+
+def count(name, label=None, n=1):
+    key = (name, label)
+    counters[key] = counters.get(key, 0) + n
+
+
+def observe(name, label, seconds):
+    key = (name, label)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(buckets) + 2)
+    histogram[bisect_left(buckets, seconds)] += 1
+    histogram[-1] += seconds
+
+
+def total(name):
+    return sum(value for (metric, _), value in counters.items() if metric == name)
+
+
+def _labels(name, label, extra=''):
+    labelName = metricInfo[name][2]
+    parts = []
+    if labelName is not None and label is not None:
+        parts.append('{}="{}"'.format(labelName, str(label).replace('\\', '\\\\').replace('"', '\\"')))
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+# Metrics in prometheus text exposition format
+def prometheus():
+    lines = []
+    for name, (kind, help, _) in sorted(metricInfo.items()):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'counter':
+            for (metric, label), value in sorted(counters.items(), key=lambda item: str(item[0])):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, _labels(name, label), value))
+        else:
+            for (metric, label), histogram in sorted(histograms.items(), key=lambda item: str(item[0])):
+                if metric == name:
+                    cumulated = 0
+                    for bound, value in zip(buckets, histogram):
+                        cumulated += value
+                        lines.append('{}_bucket{} {}'.format(name, _labels(name, label, 'le="{}"'.format(bound)), cumulated))
+                    cumulated += histogram[-2]
+                    lines.append('{}_bucket{} {}'.format(name, _labels(name, label, 'le="+Inf"'), cumulated))
+                    lines.append('{}_sum{} {}'.format(name, _labels(name, label), histogram[-1]))
+                    lines.append('{}_count{} {}'.format(name, _labels(name, label), cumulated))
+    return '\n'.join(lines) + '\n'
+
+
+# Write metrics for the node exporter textfile collector. Replaced atomically so it is never read half written
+def writePrometheus(path):
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf8') as f:
+        f.write(prometheus())
+    os.replace(temp, path)
+
+
+# One line summary of message processing since the last summary
+def summary():
+    global summarized
+    now = time.monotonic()
+    messages = total('tasmoticz_messages_total')
+    since, before = summarized
+    summarized = (now, messages)
+    seconds = sum(histogram[-1] for (metric, _), histogram in histograms.items() if metric == 'tasmoticz_message_seconds')
+    return 'messages: {} ({:.1f}/s), unmatched: {}, filtered: {}, decode failures: {}, updates: {}, suppressed: {}, created: {}, avg: {:.0f}us'.format(
+        messages, (messages - before) / max(now - since, 1e-9),
+        total('tasmoticz_unmatched_total'), total('tasmoticz_mqtt_filtered_total'),
+        total('tasmoticz_mqtt_decode_failures_total'), total('tasmoticz_updates_total'),
+        total('tasmoticz_updates_suppressed_total'), total('tasmoticz_devices_created_total'),
+        seconds / messages * 1e6 if messages else 0)
@@ -8,23 +8,16 @@
 import Domoticz
 import time
 import json
+import metrics
+import tracing
+import mqttsocket
 try:
     import random
 except:
     Domoticz.Log("mqtt: Your Python environment is incomplete!")
 
 
-mqttDebug = True
-
-
-def setMqttDebug(flag):
-    global mqttDebug
-    mqttDebug = flag
-
-
-def Debug(msg):
-    if mqttDebug:
-        Domoticz.Debug(msg)
+Debug = tracing.Tracer('mqtt', True)
                 
             
 class MqttClient:
@@ -35,13 +28,34 @@ class MqttClient:
     on_mqtt_connected_cb = None
     on_mqtt_disconnected_cb = None
     on_mqtt_message_cb = None
-
-    def __init__(self, address, port, client_id, on_mqtt_connected_cb, on_mqtt_disconnected_cb, on_mqtt_message_cb, on_mqtt_subscribed_cb):
+    on_mqtt_filter_cb = None
+    pipeline = None
+
+    # Reconnect attempts are delayed exponentially from minBackoff up to maxBackoff seconds (see onHeartbeat())
+    minBackoff = 1
+    maxBackoff = 300
+    connectTimeout = 30
+    # Seconds the broker waits for a packet from us. We ping after keepAlive / 2 seconds without sending
+    keepAlive = 60
+
+    # transport "domoticz" uses a Domoticz.Connection, "socket" the pure python mqttsocket.SocketConnection (call poll())
+    def __init__(self, address, port, client_id, on_mqtt_connected_cb, on_mqtt_disconnected_cb, on_mqtt_message_cb, on_mqtt_subscribed_cb,
+                 transport="domoticz"):
         Debug("MqttClient::__init__")
 
         self.address = address
         self.port = port
+        self.transport = transport
         self.client_id = client_id if client_id != "" else self._generate_mqtt_client_id()
+        # A persistent session only with a configured client id, generated ones would leave sessions behind on the broker
+        self.persistent = client_id != ""
+        self.cleanSession = not self.persistent
+        self.sessionPresent = False
+        self.backoff = self.minBackoff
+        self.nextAttempt = 0
+        self.opened = 0
+        self.lastSent = 0
+        self.pingSent = 0
         self.on_mqtt_connected_cb = on_mqtt_connected_cb
         self.on_mqtt_disconnected_cb = on_mqtt_disconnected_cb
         self.on_mqtt_subscribed_cb = on_mqtt_subscribed_cb
@@ -50,8 +64,15 @@ class MqttClient:
         self._open()
 
     def debug(self, flag):
-        global mqttDebug
-        mqttDebug = flag
+        Debug.enabled = flag
+
+    # Register a callback(topic) that returns False for PUBLISH topics that should be dropped undecoded
+    def setFilter(self, on_mqtt_filter_cb):
+        self.on_mqtt_filter_cb = on_mqtt_filter_cb
+
+    # Hand PUBLISH packets to worker threads of a pipeline.Pipeline instead of on_mqtt_message_cb
+    def setPipeline(self, pipeline):
+        self.pipeline = pipeline
         
     def __str__(self):
         Debug("MqttClient::__str__")
@@ -75,30 +96,46 @@ class MqttClient:
 
         self.isConnected = False
 
-        self._connection = Domoticz.Connection(
-            Name=self.address,
-            Transport="TCP/IP",
-            Protocol="MQTTS" if self.port == "8883" else "MQTT",
-            Address=self.address,
-            Port=self.port
-        )
-
+        if self.transport == "socket":
+            self._connection = mqttsocket.SocketConnection(
+                self.address, self.address, self.port, self.onConnect, self.onMessage, self.onDisconnect)
+        else:
+            self._connection = Domoticz.Connection(
+                Name=self.address,
+                Transport="TCP/IP",
+                Protocol="MQTTS" if self.port == "8883" else "MQTT",
+                Address=self.address,
+                Port=self.port
+            )
+
+        self.opened = time.monotonic()
+        self.nextAttempt = self.opened + self.backoff
+        self.backoff = min(self.backoff * 2, self.maxBackoff)
         self._connection.Connect()
 
+    def _send(self, Data):
+        self.lastSent = time.monotonic()
+        self._connection.Send(Data)
+
+    # Socket transport only: do socket I/O and process received packets, waiting up to timeout seconds
+    def poll(self, timeout=0):
+        if self.transport == "socket" and self._connection is not None:
+            self._connection.poll(timeout)
+
+    # Messages while not connected are dropped, onHeartbeat() reconnects
     def ping(self):
         Debug("MqttClient::ping")
-        if (self._connection == None or not self.isConnected):
-            self._open()
-        else:
-            self._connection.Send({'Verb': 'PING'})
+        if self.isConnected:
+            self.pingSent = time.monotonic()
+            self._send({'Verb': 'PING'})
 
     def publish(self, topic, payload, retain=0):
-        Debug("MqttClient::publish {}: '{}'".format(topic, payload))
+        Debug("MqttClient::publish {}: '{}'", topic, payload)
 
-        if (self._connection == None or not self.isConnected):
-            self._open()
+        if not self.isConnected:
+            Debug("MqttClient::publish: not connected, dropped")
         else:
-            self._connection.Send({
+            self._send({
                 'Verb': 'PUBLISH',
                 'Topic': topic,
                 'Payload': bytearray(payload, 'utf-8'),
@@ -106,16 +143,22 @@ class MqttClient:
             })
 
     def subscribe(self, topics):
-        Debug("MqttClient::subscribe to {}".format(repr(topics)))
+        Debug("MqttClient::subscribe to {!r}", topics)
         subscriptionlist = []
         for topic in topics:
             subscriptionlist.append({'Topic': topic, 'QoS': 0})
 
-        if (self._connection == None or not self.isConnected):
-            self._open()
-        else:
-            self._connection.Send(
-                {'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+        if self.isConnected:
+            self._send({'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+
+    # Start over with an empty broker session on the next connect, later ones are persistent again
+    def cleanNextSession(self):
+        self.cleanSession = True
+
+    def unsubscribe(self, topics):
+        Debug("MqttClient::unsubscribe from {!r}", topics)
+        if self.isConnected:
+            self._send({'Verb': 'UNSUBSCRIBE', 'Topics': list(topics)})
 
     def close(self):
         Debug("MqttClient::close")
@@ -134,7 +177,8 @@ class MqttClient:
         if (Status == 0):
             Domoticz.Log("MqttClient::onConnect: MQTT Server: {}:{} as {}".format(
                 Connection.Address, Connection.Port, self.client_id))
-            self._connection.Send({'Verb': 'CONNECT', 'ID': self.client_id})
+            self._send({'Verb': 'CONNECT', 'ID': self.client_id, 'CleanSession': 1 if self.cleanSession else 0,
+                        'KeepAlive': self.keepAlive})
         else:
             Domoticz.Error("MqttClient::onConnect: Failed {}:{}, Description: {}".format(
                 Connection.Address, Connection.Port, Description))
@@ -151,25 +195,44 @@ class MqttClient:
         if self.on_mqtt_disconnected_cb != None:
             self.on_mqtt_disconnected_cb()
 
+    # The connection state machine, call it regularly:
+    # not connected: (re)connect with exponential backoff, connecting: give up after connectTimeout,
+    # connected: ping when nothing was sent for keepAlive / 2, drop the connection if a ping gets no answer
     def onHeartbeat(self):
-        if self._connection is None or (not self._connection.Connecting() and not self._connection.Connected() or not self.isConnected):
-            Debug("MqttClient::Reconnecting")
+        now = time.monotonic()
+        if self.isConnected:
+            if self.pingSent and now - self.pingSent > self.keepAlive / 2:
+                Domoticz.Error("MqttClient::onHeartbeat: no answer from {}:{}".format(self.address, self.port))
+                self.close()
+                if self.on_mqtt_disconnected_cb != None:
+                    self.on_mqtt_disconnected_cb()
+            elif not self.pingSent and now - self.lastSent >= self.keepAlive / 2:
+                self.ping()
+            return
+
+        if self._connection is not None and now - self.opened < self.connectTimeout and (
+                self._connection.Connecting() or self._connection.Connected()):
+            return
+        if now >= self.nextAttempt:
+            Debug("MqttClient::onHeartbeat: Reconnecting, next attempt in {}s", self.backoff)
             self._open()
-        else:
-            self.ping()
 
     def onMessage(self, Connection, Data):
         if (self._connection != Connection):
             return
 
-        topic = Data['Topic'] if 'Topic' in Data else ''
-        try:
-            payload = Data['Payload'].decode('utf8') if 'Payload' in Data else ''
-        except:
-            return
+        metrics.count('tasmoticz_mqtt_packets_total', Data['Verb'])
+        self.pingSent = 0
 
         if Data['Verb'] == "CONNACK":
+            if Data.get('Status', 0) != 0:
+                Domoticz.Error("MqttClient::onMessage: Connection refused: {}".format(Data.get('Description', Data['Status'])))
+                self.close()
+                return
             self.isConnected = True
+            self.backoff = self.minBackoff
+            self.sessionPresent = bool(Data.get('SessionPresent', False)) and not self.cleanSession
+            self.cleanSession = not self.persistent
             if self.on_mqtt_connected_cb != None:
                 self.on_mqtt_connected_cb()
 
@@ -178,12 +241,36 @@ class MqttClient:
                 self.on_mqtt_subscribed_cb()
 
         if Data['Verb'] == "PUBLISH":
-            if self.on_mqtt_message_cb != None:
-                message = ""
-
+            if self.pipeline is not None:
+                self.pipeline.submit(Data)
+            elif self.on_mqtt_message_cb != None:
+                start = time.perf_counter()
+                tracing.sampleMessage()
                 try:
-                    message = json.loads(payload)
-                except ValueError:
-                    message = payload
+                    decoded = self.decodePublish(Data)
+                    if decoded is not None:
+                        self.on_mqtt_message_cb(*decoded)
+                finally:
+                    tracing.sampleAll()
+                metrics.observe('tasmoticz_mqtt_message_seconds', None, time.perf_counter() - start)
+
+    # Filter and decode a PUBLISH packet. Also called on pipeline worker threads
+    # Returns (topic, message) or None if the topic is filtered or the payload is not decodable
+    def decodePublish(self, Data):
+        topic = Data['Topic'] if 'Topic' in Data else ''
+        if self.on_mqtt_filter_cb != None and not self.on_mqtt_filter_cb(topic):
+            metrics.count('tasmoticz_mqtt_filtered_total')
+            return None
 
-                self.on_mqtt_message_cb(topic, message)
+        payload = Data['Payload'] if 'Payload' in Data else b''
+        try:
+            # json detects the encoding of bytes itself, no need for a decoded copy
+            message = json.loads(payload)
+        except ValueError:
+            try:
+                message = payload.decode('utf8')
+            except:
+                metrics.count('tasmoticz_mqtt_decode_failures_total')
+                return None
+
+        return topic, message
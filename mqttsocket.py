@@ -0,0 +1,336 @@
+# Pure python MQTT 3.1.1 transport as alternative to Domoticz.Connection(Protocol="MQTT")
+#
+# SocketConnection has the interface of a Domoticz MQTT connection that MqttClient uses
+# (Connect, Connected, Connecting, Send({'Verb': ...}), Disconnect) and reports events through
+# the same callbacks (onConnect, onMessage with Data dicts, onDisconnect).
+# It does not need Domoticz: the owner calls poll() to do the socket I/O.
+# Sent packets are only buffered, so many PUBLISHes go out pipelined in one write.
+
+
+import errno
+import select
+import socket
+import struct
+
+
+# MQTT control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+connackDescriptions = {
+    0: 'Connection Accepted',
+    1: 'Unacceptable protocol version',
+    2: 'Identifier rejected',
+    3: 'Server unavailable',
+    4: 'Bad user name or password',
+    5: 'Not authorized',
+}
+
+
+###########################
+# Encoding of packets
+
+
+def encodeLength(length):
+    encoded = bytearray()
+    while True:
+        digit = length % 128
+        length //= 128
+        if length:
+            digit |= 0x80
+        encoded.append(digit)
+        if not length:
+            return bytes(encoded)
+
+
+def encodeString(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return struct.pack('!H', len(value)) + bytes(value)
+
+
+def packet(type, flags, body):
+    return bytes([(type << 4) | flags]) + encodeLength(len(body)) + body
+
+
+def connectPacket(clientId, cleanSession=True, keepAlive=60, username=None, password=None):
+    flags = 0x02 if cleanSession else 0
+    payload = encodeString(clientId)
+    if username:
+        flags |= 0x80
+        payload += encodeString(username)
+        if password:
+            flags |= 0x40
+            payload += encodeString(password)
+    return packet(CONNECT, 0, encodeString('MQTT') + bytes([4, flags]) + struct.pack('!H', keepAlive) + payload)
+
+
+def connackPacket(sessionPresent, status):
+    return packet(CONNACK, 0, bytes([1 if sessionPresent else 0, status]))
+
+
+def publishPacket(topic, payload, qos=0, retain=False, packetId=None, dup=False):
+    if isinstance(payload, str):
+        payload = payload.encode('utf8')
+    flags = (qos << 1) | (1 if retain else 0) | (0x08 if dup else 0)
+    body = encodeString(topic)
+    if qos:
+        body += struct.pack('!H', packetId)
+    return packet(PUBLISH, flags, body + bytes(payload))
+
+
+def pubackPacket(packetId):
+    return packet(PUBACK, 0, struct.pack('!H', packetId))
+
+
+# One SUBSCRIBE packet for all topics: [(topic, qos), ...]
+def subscribePacket(packetId, topics):
+    body = struct.pack('!H', packetId)
+    for topic, qos in topics:
+        body += encodeString(topic) + bytes([qos])
+    return packet(SUBSCRIBE, 0x02, body)
+
+
+def subackPacket(packetId, qoss):
+    return packet(SUBACK, 0, struct.pack('!H', packetId) + bytes(qoss))
+
+
+def unsubscribePacket(packetId, topics):
+    body = struct.pack('!H', packetId)
+    for topic in topics:
+        body += encodeString(topic)
+    return packet(UNSUBSCRIBE, 0x02, body)
+
+
+def unsubackPacket(packetId):
+    return packet(UNSUBACK, 0, struct.pack('!H', packetId))
+
+
+PINGREQ_PACKET = packet(PINGREQ, 0, b'')
+PINGRESP_PACKET = packet(PINGRESP, 0, b'')
+DISCONNECT_PACKET = packet(DISCONNECT, 0, b'')
+
+
+###########################
+# Decoding of packets
+
+
+# Splits a byte stream into packets. feed() returns the complete (type, flags, body) packets
+class Parser:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        packets = []
+        pos = 0
+        while len(buffer) - pos >= 2:
+            # Remaining length: up to 4 bytes of 7 bits each, least significant first
+            length = 0
+            shift = 0
+            i = pos + 1
+            complete = False
+            while i < len(buffer) and i <= pos + 4:
+                digit = buffer[i]
+                i += 1
+                length |= (digit & 0x7f) << shift
+                shift += 7
+                if not digit & 0x80:
+                    complete = True
+                    break
+            if not complete:
+                if i > pos + 4:
+                    raise ValueError('malformed remaining length')
+                break
+            if len(buffer) - i < length:
+                break
+            packets.append((buffer[pos] >> 4, buffer[pos] & 0x0f, bytes(buffer[i:i + length])))
+            pos = i + length
+        del buffer[:pos]
+        return packets
+
+
+def decodeString(body, pos):
+    length, = struct.unpack_from('!H', body, pos)
+    pos += 2
+    return body[pos:pos + length], pos + length
+
+
+# Convert a packet to the Data dict a Domoticz MQTT connection passes to onMessage
+def packetData(type, flags, body):
+    if type == PUBLISH:
+        qos = (flags >> 1) & 0x03
+        topic, pos = decodeString(body, 0)
+        data = {'Verb': 'PUBLISH', 'Topic': topic.decode('utf8'), 'QoS': qos, 'Retain': flags & 0x01,
+                'Duplicate': (flags >> 3) & 0x01}
+        if qos:
+            data['PacketIdentifier'], = struct.unpack_from('!H', body, pos)
+            pos += 2
+        data['Payload'] = body[pos:]
+        return data
+    if type == CONNACK:
+        return {'Verb': 'CONNACK', 'SessionPresent': bool(body[0] & 0x01), 'Status': body[1],
+                'Description': connackDescriptions.get(body[1], 'Unknown')}
+    if type == SUBACK:
+        packetId, = struct.unpack_from('!H', body, 0)
+        return {'Verb': 'SUBACK', 'PacketIdentifier': packetId, 'Topics': [{'QoS': qos} for qos in body[2:]]}
+    if type in (PUBACK, UNSUBACK):
+        packetId, = struct.unpack_from('!H', body, 0)
+        return {'Verb': 'PUBACK' if type == PUBACK else 'UNSUBACK', 'PacketIdentifier': packetId}
+    if type == PINGRESP:
+        return {'Verb': 'PINGRESP'}
+    return {'Verb': 'UNKNOWN', 'Type': type}
+
+
+###########################
+# Transport
+
+
+class SocketConnection:
+    def __init__(self, Name, Address, Port, onConnect, onMessage, onDisconnect):
+        self.Name = Name
+        self.Address = Address
+        self.Port = Port
+        self.onConnect = onConnect
+        self.onMessage = onMessage
+        self.onDisconnect = onDisconnect
+        self.socket = None
+        self.connecting = False
+        self.connected = False
+        self.parser = Parser()
+        self.out = bytearray()
+        self.packetId = 0
+
+    def __str__(self):
+        return 'SocketConnection: {}:{}'.format(self.Address, self.Port)
+
+    def Connect(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        self.connecting = True
+        self.connected = False
+        self.parser = Parser()
+        self.out = bytearray()
+        status = self.socket.connect_ex((self.Address, int(self.Port)))
+        if status not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            self._close()
+            self.onConnect(self, status, errno.errorcode.get(status, str(status)))
+
+    def Connecting(self):
+        return self.connecting
+
+    def Connected(self):
+        return self.connected
+
+    def _nextPacketId(self):
+        self.packetId = self.packetId % 65535 + 1
+        return self.packetId
+
+    # Buffer a packet described like for Domoticz MQTT connections. Written by the next poll()
+    def Send(self, Data):
+        verb = Data['Verb']
+        if verb == 'CONNECT':
+            self.out += connectPacket(Data.get('ID', ''), Data.get('CleanSession', 1), Data.get('KeepAlive', 60),
+                                      Data.get('Username'), Data.get('Password'))
+        elif verb == 'PUBLISH':
+            qos = Data.get('QoS', 0)
+            self.out += publishPacket(Data['Topic'], Data.get('Payload', b''), qos, Data.get('Retain', 0),
+                                      self._nextPacketId() if qos else None)
+        elif verb == 'SUBSCRIBE':
+            self.out += subscribePacket(self._nextPacketId(), [(t['Topic'], t.get('QoS', 0)) for t in Data['Topics']])
+        elif verb == 'UNSUBSCRIBE':
+            self.out += unsubscribePacket(self._nextPacketId(),
+                                          [t['Topic'] if isinstance(t, dict) else t for t in Data['Topics']])
+        elif verb == 'PUBACK':
+            self.out += pubackPacket(Data['PacketIdentifier'])
+        elif verb == 'PING':
+            self.out += PINGREQ_PACKET
+        elif verb == 'DISCONNECT':
+            self.out += DISCONNECT_PACKET
+            self.flush()
+
+    def Disconnect(self):
+        if self.socket is not None:
+            self.flush()
+        self._close()
+
+    def _close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+        self.connecting = False
+        self.connected = False
+
+    # Write as much of the buffered packets as the socket takes without blocking
+    def flush(self):
+        if self.socket is None or self.connecting or not self.out:
+            return
+        try:
+            sent = self.socket.send(self.out)
+            del self.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._lost()
+
+    def _lost(self):
+        wasConnected = self.connected
+        self._close()
+        if wasConnected:
+            self.onDisconnect(self)
+
+    # Do pending socket I/O, waiting up to timeout seconds for it. Calls the callbacks
+    # Returns False if there is no socket (anymore)
+    def poll(self, timeout=0):
+        if self.socket is None:
+            return False
+        wants = [self.socket] if self.connecting or self.out else []
+        try:
+            readable, writable, _ = select.select([self.socket], wants, [], timeout)
+        except (OSError, ValueError):
+            self._lost()
+            return False
+
+        if self.connecting and (writable or readable):
+            status = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            self.connecting = False
+            if status:
+                self._close()
+                self.onConnect(self, status, errno.errorcode.get(status, str(status)))
+                return False
+            self.connected = True
+            self.onConnect(self, 0, 'Connected')
+
+        if readable and self.socket is not None:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self._lost()
+                return False
+            if data:
+                for type, flags, body in self.parser.feed(data):
+                    message = packetData(type, flags, body)
+                    if type == PUBLISH and message['QoS'] == 1:
+                        self.out += pubackPacket(message['PacketIdentifier'])
+                    self.onMessage(self, message)
+
+        self.flush()
+        return self.socket is not None
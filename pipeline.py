@@ -0,0 +1,143 @@
+# Optional worker threads that decode and prepare mqtt messages off the domoticz plugin thread
+#
+# The plugin thread only submits raw packets and applies prepared results in batches with drain(),
+# called from the plugin callbacks (onMessage, onCommand, onHeartbeat), so Devices are never
+# touched by worker threads. Every packet gets a sequence number and results are applied in the
+# order the packets were submitted, whatever worker prepared them first.
+# drain(timeout) waits a little for results still being prepared and applies at most batch results,
+# so no callback stalls the plugin thread. Results left over are applied by the next callback
+# (the plugin uses a short heartbeat while results are outstanding).
+
+
+import Domoticz
+import queue
+import threading
+import time
+import metrics
+import tracing
+
+
+class Pipeline:
+    def __init__(self, prepare, apply, workers=1, depth=1000, policy='oldest', batch=100):
+        self.prepare = prepare
+        self.apply = apply
+        self.policy = policy
+        self.batch = max(int(batch), 1)
+        self.frames = queue.Queue(max(int(depth), 1))
+        self.ready = threading.Condition()
+        self.results = {}   # sequence number: prepared result, an Exception or None (filtered or dropped)
+        self.submitted = 0  # next sequence number
+        self.applied = 0    # sequence number of the next result to apply
+        self.threads = []
+        for n in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self._work, name='Tasmoticz worker {}'.format(n + 1), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Queue a packet for the workers. If the queue is full, drop the oldest or this packet (policy)
+    def submit(self, frame):
+        try:
+            self.frames.put_nowait((self.submitted, frame))
+            self.submitted += 1
+            return
+        except queue.Full:
+            metrics.count('tasmoticz_pipeline_dropped_total', self.policy)
+        if self.policy == 'newest':
+            return
+        try:
+            self._skip(self.frames.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            self.frames.put_nowait((self.submitted, frame))
+            self.submitted += 1
+        except queue.Full:
+            pass
+
+    # Mark a dropped packet as done, so the results behind it are not held back
+    def _skip(self, item):
+        self.frames.task_done()
+        if item is not None:
+            self._store(item[0], None)
+
+    def _store(self, sequence, result):
+        with self.ready:
+            self.results[sequence] = result
+            self.ready.notify_all()
+
+    def _work(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                self.frames.task_done()
+                return
+            sequence, frame = item
+            try:
+                result = self.prepare(frame)
+            except Exception as e:
+                result = e
+            self._store(sequence, result)
+            self.frames.task_done()
+
+    # Apply up to batch prepared results on the plugin thread, in submit order. Waits up to timeout seconds
+    # for results still being prepared. Returns the number of results applied
+    def drain(self, timeout=0):
+        deadline = time.monotonic() + timeout
+        applied = 0
+        left = self.batch
+        while left > 0:
+            batch = []
+            with self.ready:
+                while self.applied not in self.results:
+                    remaining = deadline - time.monotonic()
+                    if self.applied >= self.submitted or remaining <= 0:
+                        break
+                    self.ready.wait(remaining)
+                while self.applied in self.results and len(batch) < left:
+                    batch.append(self.results.pop(self.applied))
+                    self.applied += 1
+            if not batch:
+                break
+            left -= len(batch)
+            tracing.flush()
+            for result in batch:
+                if result is None:
+                    continue
+                if isinstance(result, Exception):
+                    Domoticz.Error("Pipeline::drain: prepare failed: {}".format(str(result)))
+                    continue
+                try:
+                    self.apply(result)
+                except Exception as e:
+                    Domoticz.Error("Pipeline::drain: apply failed: {}".format(str(e)))
+                applied += 1
+        return applied
+
+    def depth(self):
+        return self.frames.qsize()
+
+    # Number of submitted packets whose results are not applied yet
+    def outstanding(self):
+        return self.submitted - self.applied
+
+    # Wait until all queued packets are prepared and apply them (for benchmarks)
+    def join(self):
+        self.frames.join()
+        applied = 0
+        while self.outstanding() > 0:
+            applied += self.drain()
+        return applied
+
+    # Stop the workers, queued packets are dropped. Results already prepared are still applied
+    def stop(self):
+        while True:
+            try:
+                self._skip(self.frames.get_nowait())
+            except queue.Empty:
+                break
+        for thread in self.threads:
+            self.frames.put(None)
+        for thread in self.threads:
+            thread.join(1)
+        while self.applied in self.results:
+            self.drain()
@@ -2,7 +2,7 @@
 <plugin 
     key="Tasmoticz" 
     name="Autodiscovery of Tasmota Devices"
-    version="1.3.1"
+    version="1.4.0"
     author="Joachim Banzhaf" 
     externallink="https://github.com/joba-1/Tasmoticz">
    
@@ -42,27 +42,59 @@ try:
 except Exception as e:
     errmsg += "Domoticz core start error: "+str(e)
 try:
-    from mqtt import MqttClient, setMqttDebug
+    import json
+    import os
+    import time
+except Exception as e:
+    errmsg += " json/os/time import error: "+str(e)
+try:
+    import metrics
+    import tracing
+    from profiling import Profiler, profiled
+except Exception as e:
+    errmsg += " metrics/tracing/profiling import error: "+str(e)
+try:
+    from mqtt import MqttClient
 except Exception as e:
     errmsg += " mqtt::MqttClient import error: "+str(e)
 try:
-    from tasmota import Handler, setTasmotaDebug
+    from tasmota import Handler, allocateUnit
 except Exception as e:
     errmsg += " tasmota::Handler import error: "+str(e)
+try:
+    from pipeline import Pipeline
+except Exception as e:
+    errmsg += " pipeline::Pipeline import error: "+str(e)
 
 
-pluginDebug = True
+# Arguments are formatted lazily: Debug("format {}", arg)
+Debug = tracing.Tracer('plugin', True)
 
 
-def Debug(msg):
-    if pluginDebug:
-        Domoticz.Debug(msg)
+# Optional tuning settings from tasmoticz.json in the plugin folder (see README)
+def loadSettings(folder):
+    try:
+        with open(os.path.join(folder, 'tasmoticz.json'), encoding='utf8') as f:
+            settings = json.load(f)
+        Domoticz.Log("Plugin::loadSettings: {}".format(repr(settings)))
+        return settings
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        Domoticz.Error("Plugin::loadSettings: {}".format(str(e)))
+        return {}
 
 
 class Plugin:
 
     mqttClient = None
     tasmotaHandler = None
+    pipeline = None
+    heartbeatNext = 0
+    heartbeat = 10
+    fastHeartbeat = False
+    profiler = None
+    profilerUnit = None
 
     def __init__(self):
         return
@@ -77,20 +109,52 @@ class Plugin:
                 if self.debugging == "Debug":
                     Domoticz.Debugging(2)
                 
-                global pluginDebug
-                pluginDebug = False
-                setTasmotaDebug(True)
-                setMqttDebug(False)
-                
-                Debug("Plugin::onStart: Parameters: {}".format(repr(Parameters)))
+                # Only format debug messages if domoticz would show them
+                Debug.enabled = False
+                tracing.setEnabled('tasmota', self.debugging != "Normal")
+                tracing.setEnabled('mqtt', False)
+
+                Debug("Plugin::onStart: Parameters: {!r}", Parameters)
+                self.settings = loadSettings(Parameters["HomeFolder"])
+                tracing.configure(self.settings.get('TraceSample', 1), self.settings.get('TraceBuffer', 0))
+                self.traceRequest = os.path.join(Parameters["HomeFolder"], 'tasmoticz.dump')
+                self.traceFile = os.path.join(Parameters["HomeFolder"], 'tasmoticz-trace.log')
                 self.mqttserveraddress = Parameters["Address"].strip()
                 self.mqttserverport = Parameters["Port"].strip()
                 self.mqttClient = MqttClient(self.mqttserveraddress, self.mqttserverport, Parameters["Mode5"],
                                              self.onMQTTConnected, self.onMQTTDisconnected, self.onMQTTPublish, self.onMQTTSubscribed)
                 self.mqttClient.debug(False)
                 self.tasmotaHandler = Handler(Parameters["Mode4"].strip().split('|'), Parameters["Mode1"].strip(
-                    ), Parameters["Mode2"].strip(), Parameters["Mode3"].strip(), self.mqttClient, Devices)
-                self.tasmotaHandler.debug(True)
+                    ), Parameters["Mode2"].strip(), Parameters["Mode3"].strip(), self.mqttClient, Devices, self.settings)
+                self.tasmotaHandler.debug(self.debugging != "Normal")
+
+                # Collected commands are sent within a second, other heartbeat tasks still run every 10s
+                if self.tasmotaHandler.commandWindow > 0:
+                    self.heartbeat = 1
+                    Domoticz.Heartbeat(1)
+
+                # Optional worker threads for decoding and preparing messages (see README)
+                workers = int(self.settings.get('Workers', 0))
+                if workers > 0:
+                    self.pipeline = Pipeline(self.preparePublish, self.tasmotaHandler.applyMessage, workers,
+                                             self.settings.get('QueueDepth', 1000), self.settings.get('DropPolicy', 'oldest'),
+                                             self.settings.get('DrainBatch', 100))
+                    self.mqttClient.setPipeline(self.pipeline)
+
+                # Periodic metrics log summary and prometheus textfile (see README)
+                self.metricsInterval = float(self.settings.get('MetricsInterval', 0))
+                self.metricsFile = self.settings.get('MetricsFile')
+                if self.metricsFile:
+                    self.metricsFile = os.path.join(Parameters["HomeFolder"], self.metricsFile)
+                self.metricsNext = time.monotonic() + self.metricsInterval
+
+                # Optional switch to profile the plugin callbacks (see README)
+                if self.settings.get('Profiler', False):
+                    self.profiler = Profiler(os.path.join(Parameters["HomeFolder"], 'tasmoticz-profile.pstats'),
+                                             float(self.settings.get('ProfileSeconds', 60)),
+                                             int(self.settings.get('ProfileMessages', 10000)),
+                                             int(self.settings.get('ProfileTop', 20)))
+                    self.profilerUnit = self.createProfilerDevice()
             except Exception as e:
                 Domoticz.Error("Plugin::onStart: {}".format(str(e)))
                 self.mqttClient = None
@@ -99,19 +163,78 @@ class Plugin:
                 "Plugin::onStart: Domoticz Python env error {}".format(errmsg))
             self.mqttClient = None
 
+    def onStop(self):
+        if self.profiler is not None and self.profiler.running:
+            self.stopProfiling()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.tasmotaHandler is not None:
+            self.tasmotaHandler.onStop()
+
     def debug(self, flag):
-        global pluginDebug
-        pluginDebug = flag
+        Debug.enabled = flag
 
     def checkDevices(self):
         Debug("Plugin::checkDevices")
 
+    # The profiler switch is found by its DeviceID, it has no tasmota Description
+    def createProfilerDevice(self):
+        for unit, device in Devices.items():
+            if device.DeviceID == 'Tasmoticz-Profiler':
+                if device.nValue != 0:
+                    device.Update(nValue=0, sValue='Off')
+                return unit
+        unit = allocateUnit()
+        if unit is None:
+            return None
+        Domoticz.Device(Name="Profiler", Unit=unit, TypeName="Switch", Used=1, DeviceID='Tasmoticz-Profiler').Create()
+        return unit if unit in Devices else None
+
+    def startProfiling(self):
+        try:
+            self.profiler.start()
+        except Exception as e:
+            Domoticz.Error("Plugin::startProfiling: {}".format(str(e)))
+            return
+        Domoticz.Log("Plugin::startProfiling: for {:.0f}s or {} messages".format(self.profiler.seconds, self.profiler.messages))
+        if self.profilerUnit in Devices:
+            Devices[self.profilerUnit].Update(nValue=1, sValue='On')
+
+    # Write the profile, log its summary and switch the profiler off
+    def stopProfiling(self):
+        try:
+            for line in self.profiler.stop():
+                Domoticz.Log("Plugin::profile: {}".format(line))
+        except Exception as e:
+            Domoticz.Error("Plugin::stopProfiling: {}".format(str(e)))
+        if self.profilerUnit in Devices:
+            Devices[self.profilerUnit].Update(nValue=0, sValue='Off')
+
     # Let tasmotaHandler react to commands from Domoticz
 
+    @profiled()
     def onCommand(self, Unit, Command, Level, Color):
+        if self.profilerUnit is not None and Unit == self.profilerUnit:
+            if Command == 'On' and not self.profiler.running:
+                self.startProfiling()
+            elif Command == 'Off' and self.profiler.running:
+                self.stopProfiling()
+            return True
         if self.mqttClient is None:
             return False
-        return self.tasmotaHandler.onDomoticzCommand(Unit, Command, Level, Color)
+        # Publish first, prepared results must not delay a click
+        self.tasmotaHandler.flushCommands()
+        handled = self.tasmotaHandler.onDomoticzCommand(Unit, Command, Level, Color)
+        self.drainPipeline()
+        return handled
+
+    def onDeviceRemoved(self, Unit):
+        if self.tasmotaHandler is not None:
+            self.tasmotaHandler.onDeviceRemoved(Unit)
+
+    def onDeviceModified(self, Unit):
+        if self.tasmotaHandler is not None:
+            self.tasmotaHandler.onDeviceModified(Unit)
 
     def onConnect(self, Connection, Status, Description):
         Debug("Plugin::onConnect")
@@ -122,23 +245,63 @@ class Plugin:
         if self.mqttClient is not None:
             self.mqttClient.onDisconnect(Connection)
 
+    @profiled(counted=True)
     def onMessage(self, Connection, Data):
         if self.mqttClient is not None:
             self.mqttClient.onMessage(Connection, Data)
+            # Without a backlog the workers prepare this message right away, wait for it
+            if self.pipeline is not None:
+                self.drainPipeline(0.05 if self.pipeline.outstanding() <= len(self.pipeline.threads) else 0)
+            if self.tasmotaHandler is not None:
+                self.tasmotaHandler.flushCommands()
 
+    @profiled()
     def onHeartbeat(self):
         Debug("Plugin::onHeartbeat")
         if self.mqttClient is not None:
             try:
-                # Reconnect if connection has dropped
-                if (self.mqttClient._connection is None) or (not self.mqttClient.isConnected):
-                    Debug("Plugin::onHeartbeat: Reconnecting")
-                    self.mqttClient._open()
-                else:
-                    self.mqttClient.ping()
+                # (Re)connects with backoff and keeps the connection alive
+                self.mqttClient.onHeartbeat()
+                self.tasmotaHandler.flushCommands()
+                self.drainPipeline()
+                if time.monotonic() < self.heartbeatNext:
+                    return
+                self.heartbeatNext = time.monotonic() + 9.5
+                self.tasmotaHandler.onHeartbeat(self.pipeline.depth() if self.pipeline is not None else 0)
+                self.publishMetrics()
+                self.dumpTraces()
             except Exception as e:
                 Domoticz.Error("Plugin::onHeartbeat error {}".format(str(e)))
 
+    # Apply results prepared by the workers. Results still being prepared are applied by the next callback,
+    # a 1s heartbeat makes sure that is soon
+    def drainPipeline(self, timeout=0):
+        if self.pipeline is None:
+            return
+        self.pipeline.drain(timeout)
+        fast = self.pipeline.outstanding() > 0
+        if fast != self.fastHeartbeat and self.heartbeat > 1:
+            self.fastHeartbeat = fast
+            Domoticz.Heartbeat(1 if fast else self.heartbeat)
+
+    # Dump the trace ring buffer if requested by creating the file tasmoticz.dump in the plugin folder
+    def dumpTraces(self):
+        if not os.path.exists(self.traceRequest):
+            return
+        os.remove(self.traceRequest)
+        Domoticz.Log("Plugin::dumpTraces: {} traces written to {}".format(tracing.dump(self.traceFile), self.traceFile))
+
+    def publishMetrics(self):
+        if self.metricsInterval <= 0 or time.monotonic() < self.metricsNext:
+            return
+        self.metricsNext = time.monotonic() + self.metricsInterval
+        Domoticz.Log("Plugin::metrics: {}".format(metrics.summary()))
+        if self.metricsFile:
+            try:
+                metrics.writePrometheus(self.metricsFile)
+            except Exception as e:
+                Domoticz.Error("Plugin::publishMetrics: {}".format(str(e)))
+
     # Let tasmotaHandler subscribe its topics
 
     def onMQTTConnected(self):
@@ -156,6 +319,17 @@ class Plugin:
     def onMQTTPublish(self, topic, message):
         return self.tasmotaHandler.onMQTTPublish(topic, message)
 
+    # Runs on pipeline worker threads: decode and prepare a PUBLISH packet for tasmotaHandler.applyMessage()
+    def preparePublish(self, Data):
+        tracing.sampleMessage()
+        try:
+            decoded = self.mqttClient.decodePublish(Data)
+            if decoded is None:
+                return None
+            return self.tasmotaHandler.prepareMessage(*decoded)
+        finally:
+            tracing.sampleAll()
+
 
 # Domoticz Python Plugin Interface
 
@@ -168,6 +342,11 @@ def onStart():
     _plugin.onStart()
 
 
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
+
 def onConnect(Connection, Status, Description):
     global _plugin
     _plugin.onConnect(Connection, Status, Description)
@@ -188,6 +367,16 @@ def onCommand(Unit, Command, Level, Color):
     _plugin.onCommand(Unit, Command, Level, Color)
 
 
+def onDeviceRemoved(Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(Unit)
+
+
+def onDeviceModified(Unit):
+    global _plugin
+    _plugin.onDeviceModified(Unit)
+
+
 def onHeartbeat():
     global _plugin
     _plugin.onHeartbeat()
@@ -0,0 +1,87 @@
+# On demand cProfile capture of the plugin callbacks
+#
+# Methods decorated with @profiled() are profiled while the profiler attribute of their object is started:
+# self.profiler = Profiler(path, seconds=60, messages=10000, top=20)
+# self.profiler.start()
+#
+# Only the plugin thread is profiled, pipeline worker threads are not.
+# A capture stops after the given seconds or number of mqtt messages, writes the stats for pstats
+# (python3 -m pstats tasmoticz-profile.pstats) and returns a summary of the top functions.
+
+
+import functools
+import time
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+
+
+class Profiler:
+    def __init__(self, path, seconds=60, messages=10000, top=20):
+        self.path = path
+        self.seconds = seconds
+        self.messages = messages
+        self.top = top
+        self.profile = None
+        self.started = 0
+        self.count = 0
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        if cProfile is None:
+            raise RuntimeError('cProfile is not available in this python')
+        self.profile = cProfile.Profile()
+        self.started = time.monotonic()
+        self.count = 0
+
+    # True if the capture has reached its time or message limit
+    def done(self):
+        return time.monotonic() - self.started >= self.seconds or self.count >= self.messages
+
+    # Stop the capture, write the stats file and return the summary lines
+    def stop(self):
+        profile = self.profile
+        self.profile = None
+        if profile is None:
+            return []
+        elapsed = time.monotonic() - self.started
+        stats = pstats.Stats(profile)
+        stats.dump_stats(self.path)
+        stats.sort_stats('cumulative')
+        lines = ['{} messages in {:.0f}s, {} calls, {:.3f}s cpu, stats in {}'.format(
+            self.count, elapsed, stats.total_calls, stats.total_tt, self.path)]
+        lines.append('{:>9} {:>9} {:>9}  {}'.format('calls', 'tottime', 'cumtime', 'function'))
+        for func in stats.fcn_list[:self.top]:
+            _, calls, tottime, cumtime, _ = stats.stats[func]
+            lines.append('{:9} {:9.3f} {:9.3f}  {}'.format(calls, tottime, cumtime, pstats.func_std_string(func)))
+        return lines
+
+
+# Decorator for methods of an object with a profiler attribute (a Profiler or None) and a stopProfiling() method
+# Profiles the method while the profiler is running and calls stopProfiling() when the capture is done
+# counted: the method handles a message
+def profiled(counted=False):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if profiler is None or profiler.profile is None:
+                return method(self, *args, **kwargs)
+            if counted:
+                profiler.count += 1
+            profile = profiler.profile
+            profile.enable()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                profile.disable()
+                if profiler.profile is profile and profiler.done():
+                    self.stopProfiling()
+        return wrapper
+    return decorator
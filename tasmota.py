@@ -2,6 +2,8 @@ try:
     import collections.abc as collections
 except ImportError:  # Python <= 3.2 including Python 2
     import collections
+from collections import OrderedDict
+from types import MappingProxyType
 
 errmsg = ""
 try:
@@ -18,62 +20,147 @@ except Exception as e:
     errmsg += " binascii import error: "+str(e)
 
 try:
-    from datetime import datetime, timedelta
+    import heapq
+    import threading
     import time
 except Exception as e:
-    errmsg+= " datetime import error: "+str(e)
+    errmsg+= " time import error: "+str(e)
+try:
+    import metrics
+    import tracing
+except Exception as e:
+    errmsg += " metrics/tracing import error: "+str(e)
 
-tasmotaDebug = True
 
+# Replaces Domoticz.Debug() so tasmota related messages can be turned off from plugin.py
+# Arguments are formatted lazily: Debug("format {}", arg)
+Debug = tracing.Tracer('tasmota', True)
 
-# Decide if tasmota.py debug messages should be displayed if domoticz debug is enabled for this plugin
-def setTasmotaDebug(flag):
-    global tasmotaDebug
-    tasmotaDebug = flag
 
-
-# Replaces Domoticz.Debug() so tasmota related messages can be turned off from plugin.py
-def Debug(msg):
-    if tasmotaDebug:
-        Domoticz.Debug(msg)
+# GroupTopics tasmota devices have by default, never used for group commands
+defaultGroupTopics = frozenset(('tasmotas', 'sonoffs'))
 
 
 # Handles incoming Tasmota messages from MQTT or Domoticz commands for Tasmota devices
 class Handler:
-    def __init__(self, subscriptions, prefix1, prefix2, prefix3, mqttClient, devices):
-        Debug("Handler::__init__(cmnd: {}, stat: {}, tele: {}, subs: {})".format(
-            prefix1, prefix2, prefix3, repr(subscriptions)))
+    def __init__(self, subscriptions, prefix1, prefix2, prefix3, mqttClient, devices, settings=None):
+        Debug("Handler::__init__(cmnd: {}, stat: {}, tele: {}, subs: {!r})",
+            prefix1, prefix2, prefix3, subscriptions)
 
         if errmsg != "":
             Domoticz.Error(
                 "Handler::__init__: Domoticz Python env error {}".format(errmsg))
 
-        # So far only STATUS, STATE, SENSOR and RESULT are used. Others just for research...
-        self.topics = ['INFO1', 'STATE', 'SENSOR', 'RESULT', 'STATUS',
+        # So far only STATUS, STATUS1, STATE, SENSOR and RESULT are used. Others just for research...
+        self.topics = ['INFO1', 'STATE', 'SENSOR', 'RESULT', 'STATUS', 'STATUS1',
                        'STATUS5', 'STATUS8', 'STATUS11', 'ENERGY']
+        # Tails subscribed per prefix (see onMQTTConnected())
+        self.teleTopics = ['INFO1', 'STATE', 'SENSOR']
+        self.statTopics = ['RESULT', 'STATUS']
 
         self.prefix = [None, prefix1, prefix2, prefix3]
         self.subscriptions = subscriptions
+
+        # Subscription patterns split once and a LRU cache of resolved topics (see resolveTopic())
+        # Locked, because topics can be resolved on worker threads
+        self.patterns = [subscription.split('/') for subscription in subscriptions]
+        self.topicCache = OrderedDict()
+        self.topicCacheSize = 1024
+        self.topicLock = threading.Lock()
         self.mqttClient = mqttClient
+        self.subscribed = False
+        # Topics subscribed in the broker session, kept in the plugin configuration
+        # so subscriptions no longer needed after a settings change can be removed from a persistent session
+        self.subscribedTopics = set()
+        if mqttClient is not None:
+            mqttClient.setFilter(self.acceptTopic)
+            # Without the topics of an earlier run (first run or no plugin configuration) none can be
+            # unsubscribed, start with an empty session instead
+            if loadConfiguration('Subscriptions', None) is None:
+                mqttClient.cleanNextSession()
 
         # I don't understand variable (in)visibility
         global Devices
         Devices = devices
 
+        # Optional tuning from tasmoticz.json, see README
+        if settings is None:
+            settings = {}
+        global updateDelay, combineSensors
+        updateDelay = float(settings.get('UpdateDelay', updateDelay))
+        combineSensors = bool(settings.get('CombineSensors', False))
+        deadBands.clear()
+        deadBands.update(settings.get('DeadBand', {}))
+        addSensorTypes(settings.get('SensorTypes', {}))
+
+        # STATUS requests are queued per device and sent rate limited by a token bucket (see sendStatusRequests())
+        # cmndName -> time of request, at most one request per device in flight
+        self.statusQueue = OrderedDict()
+        self.statusInFlight = {}
+        self.statusRate = float(settings.get('StatusRate', 1))
+        self.statusBurst = float(settings.get('StatusBurst', 10))
+        self.statusTimeout = 60
+        self.statusTokens = self.statusBurst
+        self.statusRefill = time.monotonic()
+
+        # Commands to a device within CommandWindow seconds are sent as one Backlog command (see flushCommands())
+        # cmndName -> (deadline, [(command, payload), ...])
+        self.commandWindow = float(settings.get('CommandWindow', 0))
+        self.pendingCommands = OrderedDict()
+
+        # Identical collected commands to all members of a tasmota GroupTopic are sent once to the group
+        # GroupTopics are learned from STATUS1. group cmndName -> set of member cmndNames and reverse
+        # groupReported: cmndNames that sent STATUS1, a group is only used if all our devices did
+        self.groupCommands = bool(settings.get('GroupCommands', False))
+        self.groups = {}
+        self.groupOf = {}
+        self.groupReported = set()
+        if self.groupCommands:
+            self.statTopics.append('STATUS1')
+
+        # Optionally subscribe only the topics of known devices and INFO1 of all for discovery
+        self.exactSubscriptions = bool(settings.get('ExactSubscriptions', False))
+        self.exactDevices = set()
+
+        # Optional TelePeriod control: lengthen the period of devices with unchanged values if over budget
+        # (messages per second of all, per minute of each device) or the worker queue is backlogged
+        # cmndName -> state, see trackTele() and controlTelePeriods()
+        self.teleBudget = float(settings.get('TeleBudget', 0))
+        self.teleDeviceBudget = float(settings.get('TeleDeviceBudget', 0))
+        self.teleBacklog = int(settings.get('TeleBacklog', 100))
+        self.telePeriodMax = int(settings.get('TelePeriodMax', 3600))
+        self.teleInterval = float(settings.get('TeleInterval', 300))
+        self.teleControl = self.teleBudget > 0 or self.teleDeviceBudget > 0
+        self.teleStates = {}
+        self.teleChecked = time.monotonic()
+
+        # Optionally switches show the commanded state immediately, until confirmed or timed out (see checkCommands())
+        self.optimistic = bool(settings.get('Optimistic', False))
+        self.commandTimeout = float(settings.get('CommandTimeout', 5))
+        self.commandRetries = int(settings.get('CommandRetries', 1))
+
+        loadDeviceInfos()
+        buildIndex()
+        migrateDescriptions()
+
+        # Learn the GroupTopics of all known devices, not only of new or rebooted ones
+        if self.groupCommands:
+            for cmndName in deviceTopics.values():
+                self.requestStatus(cmndName)
+
     def debug(self, flag):
-        global tasmotaDebug
-        tasmotaDebug = flag
+        Debug.enabled = flag
 
     # Translate domoticz command to tasmota mqtt command(s?)
     def onDomoticzCommand(self, Unit, Command, Level, Color):
-        Debug("Handler::onDomoticzCommand: Unit: {}, Command: {}, Level: {}, Color: {}".format(
-            Unit, Command, Level, Color))
+        Debug("Handler::onDomoticzCommand: Unit: {}, Command: {}, Level: {}, Color: {}",
+            Unit, Command, Level, Color)
 
         if self.mqttClient is None:
             return False
 
         try:
-            description = json.loads(Devices[Unit].Description)
+            description = getDescription(Unit)
             topic = '{}/{}'.format(description['Topic'],
                                    description['Command'])
         except:
@@ -84,98 +171,460 @@ class Handler:
             Debug("Handler::onDomoticzCommand: no message")
             return False
 
+        if self.commandWindow > 0:
+            pending = self.pendingCommands.get(description['Topic'])
+            if pending is None:
+                pending = (time.monotonic() + self.commandWindow, [])
+                self.pendingCommands[description['Topic']] = pending
+            pending[1].append((description['Command'], msg))
+        else:
+            try:
+                self.mqttClient.publish(topic, msg)
+                metrics.count('tasmoticz_commands_total', 'direct')
+            except Exception as e:
+                Domoticz.Error("Handler::onDomoticzCommand: {}".format(str(e)))
+                return False
+
+        if self.optimistic:
+            self.updateOptimistic(Unit, description['Command'], topic, msg)
+        return True
+
+    # Show the commanded state before the device confirms it. The state before is kept for a rollback
+    def updateOptimistic(self, idx, attr, topic, msg):
+        device = Devices[idx]
+        expected = t2d(attr, msg.upper(), device.Type, device.SubType)
+        entry = unconfirmed.get(idx)
+        previous = entry[1] if entry is not None else (device.nValue, device.sValue)
+        unconfirmed[idx] = [time.monotonic() + self.commandTimeout, previous, expected, topic, msg, self.commandRetries]
+        if (device.nValue, device.sValue) != expected:
+            Debug("Handler::updateOptimistic: Idx: {}, nValue: {}, sValue: {}", idx, expected[0], expected[1])
+            device.Update(nValue=expected[0], sValue=expected[1])
+            lastWrites[idx] = time.monotonic()
+            metrics.count('tasmoticz_updates_total')
+
+    # Resend commands that were not confirmed in time, roll back the optimistic update after the last retry
+    def checkCommands(self):
+        now = time.monotonic()
+        for idx, entry in list(unconfirmed.items()):
+            deadline, previous, expected, topic, msg, retries = entry
+            if deadline > now:
+                continue
+            if retries > 0:
+                Debug("Handler::checkCommands: Idx: {}, resending {} {}", idx, topic, msg)
+                entry[0] = now + self.commandTimeout
+                entry[5] = retries - 1
+                try:
+                    self.mqttClient.publish(topic, msg)
+                except Exception as e:
+                    Domoticz.Error("Handler::checkCommands: {}".format(str(e)))
+                metrics.count('tasmoticz_commands_unconfirmed_total', 'retried')
+                continue
+            del unconfirmed[idx]
+            Domoticz.Error("Handler::checkCommands: {} {} not confirmed, idx {} reset to {}".format(
+                topic, msg, idx, previous[1]))
+            if idx in Devices:
+                Devices[idx].Update(nValue=previous[0], sValue=previous[1])
+                lastWrites[idx] = now
+            metrics.count('tasmoticz_commands_unconfirmed_total', 'rolled_back')
+
+    # Publish commands collected longer than CommandWindow (all if force)
+    # Several commands to the same device are joined to one Backlog command, tasmota executes them in order
+    def flushCommands(self, force=False):
+        if not self.pendingCommands:
+            return
+        now = time.monotonic()
+        while self.pendingCommands:
+            cmndName, (deadline, commands) = next(iter(self.pendingCommands.items()))
+            if deadline > now and not force:
+                break
+            group = self.groupOf.get(cmndName)
+            if group is not None and self.groupCovered(group, commands):
+                # Members report their new state with RESULT as usual
+                for member in self.groups[group]:
+                    del self.pendingCommands[member]
+                self.publishCommands(group, commands, 'group', len(commands) * len(self.groups[group]))
+                continue
+            del self.pendingCommands[cmndName]
+            self.publishCommands(cmndName, commands, 'batched', len(commands))
+
+    # True if all members of the group have the same commands collected
+    # Membership is only complete if every device we know has reported its GroupTopic
+    def groupCovered(self, group, commands):
+        members = self.groups[group]
+        return len(members) > 1 and all(
+            member in self.pendingCommands and self.pendingCommands[member][1] == commands for member in members
+        ) and all(cmndName in self.groupReported for cmndName in deviceTopics.values())
+
+    def publishCommands(self, cmndName, commands, mode, n):
+        if len(commands) == 1:
+            topic = '{}/{}'.format(cmndName, commands[0][0])
+            msg = commands[0][1]
+        else:
+            topic = '{}/Backlog'.format(cmndName)
+            msg = '; '.join('{} {}'.format(command, payload) for command, payload in commands)
+        Debug("Handler::publishCommands: {} {}", topic, msg)
         try:
             self.mqttClient.publish(topic, msg)
+            metrics.count('tasmoticz_commands_total', mode, n)
         except Exception as e:
-            Domoticz.Error("Handler::onDomoticzCommand: {}".format(str(e)))
-            return False
+            Domoticz.Error("Handler::publishCommands: {}".format(str(e)))
 
-        return True
+    # Learn the GroupTopic of a device from its STATUS1 message
+    def updateGroup(self, cmndName, message):
+        try:
+            groupTopic = message["StatusPRM"]["GroupTopic"]
+        except (KeyError, TypeError):
+            return
+        self.groupReported.add(cmndName)
+        # The default GroupTopics are shared by all tasmota devices on the broker, even ones we don't know
+        if groupTopic in defaultGroupTopics:
+            group = None
+        else:
+            group = self.deviceTopic(cmndName, topic=groupTopic)
+        old = self.groupOf.get(cmndName)
+        if old == group:
+            return
+        Debug("Handler::updateGroup: {} from {} to {}", cmndName, old, group)
+        if old is not None:
+            self.groups[old].discard(cmndName)
+            if not self.groups[old]:
+                del self.groups[old]
+            del self.groupOf[cmndName]
+        if group is not None:
+            self.groups.setdefault(group, set()).add(cmndName)
+            self.groupOf[cmndName] = group
+
+    # The cmndName of a device with %prefix% and/or %topic% of its FullTopic pattern replaced
+    # E.g. the command topic of its group or its stat or tele topic (without tail)
+    def deviceTopic(self, cmndName, prefix=None, topic=None):
+        subtopics = cmndName.split('/')
+        for patterns in self.patterns:
+            if len(patterns) == len(subtopics) and all(
+                    pattern in ('+', '%topic%', subtopic) or (pattern == '%prefix%' and subtopic == self.prefix[1])
+                    for subtopic, pattern in zip(subtopics, patterns)):
+                return '/'.join(topic if pattern == '%topic%' and topic is not None else
+                                prefix if pattern == '%prefix%' and prefix is not None else subtopic
+                                for subtopic, pattern in zip(subtopics, patterns))
+        return None
+
+    # Write buffered values to domoticz
+    # backlog: messages waiting for processing
+    def onHeartbeat(self, backlog=0):
+        self.flushCommands()
+        if unconfirmed:
+            self.checkCommands()
+        flushUpdates()
+        refreshKeepalives()
+        self.sendStatusRequests()
+        if self.teleControl:
+            self.controlTelePeriods(backlog)
+
+    def onStop(self):
+        self.flushCommands(True)
+        flushUpdates()
+        # TelePeriod is saved on the devices, don't leave them slowed down
+        for cmndName, state in self.teleStates.items():
+            if state['period'] is not None:
+                self.setTelePeriod(cmndName, state, None)
+
+    # Forget a unit deleted in domoticz
+    def onDeviceRemoved(self, Unit):
+        Debug("Handler::onDeviceRemoved: Unit: {}", Unit)
+        unindexUnit(Unit)
+
+    # Reparse the Description of a unit edited in domoticz on next use
+    def onDeviceModified(self, Unit):
+        Debug("Handler::onDeviceModified: Unit: {}", Unit)
+        descriptionCache.pop(Unit, None)
+        if Unit in unitTypes and Unit in Devices:
+            unitTypes[Unit] = (Devices[Unit].Type, Devices[Unit].SubType)
 
     # Subscribe to our topics
     def onMQTTConnected(self):
+        # The broker kept our subscriptions of this run in the persistent session
+        if self.subscribed and self.mqttClient.sessionPresent:
+            Debug('Handler::onMQTTConnected: Session resumed')
+            return
+        self.exactDevices.clear()
+        if self.exactSubscriptions:
+            self.exactDevices.update(deviceTopics.values())
         subs = []
         for topic in self.subscriptions:
             topic = topic.replace('%topic%', '+')
-            subs.append(topic.replace('%prefix%', self.prefix[2]) + '/+')
-            subs.append(topic.replace('%prefix%', self.prefix[3]) + '/+')
-        Debug('Handler::onMQTTConnected: Subscriptions: {}'.format(repr(subs)))
+            if self.exactDevices:
+                subs.append('{}/INFO1'.format(topic.replace('%prefix%', self.prefix[3])))
+            else:
+                subs.extend('{}/{}'.format(topic.replace('%prefix%', self.prefix[2]), tail) for tail in self.statTopics)
+                subs.extend('{}/{}'.format(topic.replace('%prefix%', self.prefix[3]), tail) for tail in self.teleTopics)
+        for cmndName in self.exactDevices:
+            subs.extend(self.exactTopics(cmndName))
+        Debug('Handler::onMQTTConnected: Subscriptions: {!r}', subs)
+        removed = sorted(set(loadConfiguration('Subscriptions', ())) - set(subs))
+        if removed:
+            Debug('Handler::onMQTTConnected: Unsubscribe: {!r}', removed)
+            self.mqttClient.unsubscribe(removed)
         self.mqttClient.subscribe(subs)
+        self.subscribed = True
+        self.subscribedTopics = set(subs)
+        saveConfiguration('Subscriptions', sorted(self.subscribedTopics))
+
+    # Topics of one device without INFO1 (subscribed for all devices)
+    def exactTopics(self, cmndName):
+        stat = self.deviceTopic(cmndName, prefix=self.prefix[2])
+        tele = self.deviceTopic(cmndName, prefix=self.prefix[3])
+        if stat is None or tele is None:
+            return []
+        return (['{}/{}'.format(stat, tail) for tail in self.statTopics] +
+                ['{}/{}'.format(tele, tail) for tail in self.teleTopics if tail != 'INFO1'])
+
+    # Subscribe the topics of a device discovered by its INFO1 while only known devices are subscribed
+    def subscribeDevice(self, cmndName):
+        self.exactDevices.add(cmndName)
+        subs = self.exactTopics(cmndName)
+        Debug('Handler::subscribeDevice: Subscriptions: {!r}', subs)
+        if subs:
+            self.mqttClient.subscribe(subs)
+            self.subscribedTopics.update(subs)
+            saveConfiguration('Subscriptions', sorted(self.subscribedTopics))
+
+    # Filter for the mqtt client: only topics we handle are worth decoding
+    def acceptTopic(self, topic):
+        head, _, tail = topic.rpartition('/')
+        if tail not in self.topics:
+            return False
+        if self.resolveTopic(head) is None:
+            metrics.count('tasmoticz_unmatched_total')
+            return False
+        return True
 
     # Process incoming MQTT messages from Tasmota devices
-    # Call Update{subtopic}Devices() if it is potentially one of ours
     def onMQTTPublish(self, topic, message):
-        Debug("Handler::onMQTTPublish: topic: {}".format(topic))
+        prepared = self.prepareMessage(topic, message)
+        if prepared is not None:
+            self.applyMessage(prepared)
+        return True
+
+    # First part of processing a message, without touching Devices, so it can run on a worker thread:
+    # Match the topic, extract values and convert them for known units
+    # Returns (tail, fullName, cmndName, message, values, start) or None if it is not one of ours
+    def prepareMessage(self, topic, message):
+        Debug("Handler::prepareMessage: topic: {}", topic)
+        start = time.perf_counter()
 
         # Check if we handle this topic tail at all (hardcoded list SENSOR, STATUS, ...)
-        subtopics = topic.split('/')
-        tail = subtopics[-1]
+        head, _, tail = topic.rpartition('/')
         if tail not in self.topics:
-            return True
+            return None
 
-        # Different Tasmota devices can have different FullTopic patterns.
-        # All FullTopic patterns we care about are in self.subscriptions (plugin config)
-        # Tasmota devices will be identified by a hex hash from FullTopic without %prefix%
+        resolved = self.resolveTopic(head)
+        if resolved is None:
+            return None
+        fullName, cmndName = resolved
 
-        # Identify the subscription that matches our received subtopics
-        fulltopic = []
-        cmndtopic = []
-        for subscription in self.subscriptions:
-            patterns = subscription.split('/')
-            for subtopic, pattern in zip(subtopics[:-1], patterns):
-                if((pattern not in ('%topic%', '%prefix%', '+', subtopic)) or
-                    (pattern == '%prefix%' and subtopic != self.prefix[2] and subtopic != self.prefix[3]) or
-                        (pattern == '%topic%' and (subtopic == 'sonoff' or subtopic == 'tasmota'))):
-                    fulltopic = []
-                    cmndtopic = []
-                    break
-                if(pattern != '%prefix%'):
-                    fulltopic.append(subtopic)
-                    cmndtopic.append(subtopic)
-                else:
-                    cmndtopic.append(self.prefix[1])
-            if fulltopic != []:
-                break
+        # fullName should now contain all subtopic parts except for %prefix%es and tail
+        # I.e. fullName is uniquely identifying the sensor or button referred by the message
+        Debug("Handler::prepareMessage: device: {}, cmnd: {}, tail: {}, message: {}",
+            fullName, cmndName, tail, message)
 
-        if not fulltopic:
-            return True
+        values = None
+        if tail == 'STATE':
+            values = prepareValues(fullName, [(attr, value, None, None) for attr, value in getStateDevices(message)])
+        elif tail == 'SENSOR':
+            values = prepareValues(fullName, getSensorValues(message))
 
-        fullName = '/'.join(fulltopic)
-        cmndName = '/'.join(cmndtopic)
+        return tail, fullName, cmndName, message, values, start
 
-        # fullName should now contain all subtopic parts except for %prefix%es and tail
-        # I.e. fullName is uniquely identifying the sensor or button referred by the message
-        Debug("Handler::onMQTTPublish: device: {}, cmnd: {}, tail: {}, message: {}".format(
-            fullName, cmndName, tail, str(message)))
+    # Second part of processing a message on the plugin thread:
+    # Call Update{subtopic}Devices() with the prepared message
+    def applyMessage(self, prepared):
+        tail, fullName, cmndName, message, values, start = prepared
 
         if tail == 'STATE':  # POWER* status
-            if updateStateDevices(fullName, cmndName, message):
+            if updateDevices(fullName, cmndName, values):
                 self.requestStatus(cmndName)
+            if self.teleControl:
+                self.trackTele(cmndName, tail, values)
         elif tail == 'SENSOR':
-            if updateSensorDevices(fullName, cmndName, message):
+            if updateDevices(fullName, cmndName, values):
                 self.requestStatus(cmndName)
+            if self.teleControl:
+                self.trackTele(cmndName, tail, values)
         elif tail == 'RESULT':  # POWER* change
+            if self.teleControl and 'TelePeriod' in message:
+                self.updateTelePeriod(cmndName, message['TelePeriod'])
             updateResultDevice(fullName, message)
         elif tail == 'STATUS':  # Friendly names
+            self.statusInFlight.pop(cmndName, None)
             updateStatusDevices(fullName, cmndName, message)
+        elif tail == 'STATUS1':  # GroupTopic
+            self.updateGroup(cmndName, message)
         elif tail == 'INFO1':  # update module and version in device description
             updateInfo1Devices(fullName, cmndName, message)
             self.requestStatus(cmndName)
+            if self.exactDevices and cmndName not in self.exactDevices:
+                self.subscribeDevice(cmndName)
         elif tail == 'STATUS5':  # nop
             updateNetDevices(fullName, cmndName, message)
         elif tail == 'ENERGY':  # nop
             updateEnergyDevices(fullName, cmndName, message)
 
-        return True
+        if pendingUpdates and time.monotonic() - pendingSince >= updateDelay:
+            flushUpdates()
+        if self.statusQueue:
+            self.sendStatusRequests()
+
+        metrics.count('tasmoticz_messages_total', tail)
+        metrics.observe('tasmoticz_message_seconds', tail, time.perf_counter() - start)
+
+    # Count tele messages of a device, learn its TelePeriod from the STATE intervals and if the values of its units change
+    def trackTele(self, cmndName, tail, values):
+        state = self.teleStates.get(cmndName)
+        if state is None:
+            state = {'count': 0, 'last': None, 'base': None, 'device': None, 'period': None, 'values': {},
+                     'still': 0, 'moved': False}
+            self.teleStates[cmndName] = state
+            self.queryTelePeriod(cmndName)
+        state['count'] += 1
+        if tail == 'STATE':
+            now = time.monotonic()
+            if state['last'] is not None and state['period'] is None:
+                interval = min(max(now - state['last'], 10), 3600)
+                state['base'] = interval if state['base'] is None else 0.8 * state['base'] + 0.2 * interval
+            state['last'] = now
+        # Diagnostics like Heap, LoadAvg or RSSI always change, only compare values shown by units
+        key = tuple((value[0], value[1]) for value in values
+                    if value[0] not in teleNoise and (value[4] is not None or value[0] in powerAttrs))
+        if state['values'].get(tail, key) != key:
+            state['still'] = 0
+            state['moved'] = True
+        else:
+            state['still'] += 1
+        state['values'][tail] = key
+
+    # Every TeleInterval seconds: double the TelePeriod of still devices while over budget,
+    # restore it if values of a device change or the load is low again
+    def controlTelePeriods(self, backlog):
+        now = time.monotonic()
+        elapsed = now - self.teleChecked
+        if elapsed < self.teleInterval:
+            return
+        self.teleChecked = now
+        rate = sum(state['count'] for state in self.teleStates.values()) / elapsed
+        overloaded = (self.teleBudget > 0 and rate > self.teleBudget) or backlog > self.teleBacklog
+        relaxed = (self.teleBudget <= 0 or rate < self.teleBudget / 2) and backlog == 0
+        Debug("Handler::controlTelePeriods: {:.2f} msgs/s, backlog {}", rate, backlog)
+        for cmndName, state in self.teleStates.items():
+            base = state['device'] or state['base'] or 300
+            period = state['period'] or base
+            deviceRate = state['count'] * 60 / elapsed
+            if state['period'] is not None and (state['moved'] or (
+                    relaxed and (self.teleDeviceBudget <= 0 or 60 / base <= self.teleDeviceBudget))):
+                self.setTelePeriod(cmndName, state, None)
+            elif ((overloaded or (self.teleDeviceBudget > 0 and deviceRate > self.teleDeviceBudget)) and
+                    state['still'] >= 3 and period < self.telePeriodMax):
+                # Only change a TelePeriod that can be restored
+                if state['device'] is None:
+                    self.queryTelePeriod(cmndName)
+                else:
+                    self.setTelePeriod(cmndName, state, min(int(period * 2), self.telePeriodMax))
+            state['count'] = 0
+            state['moved'] = False
 
-    # Request device STATUS via mqtt
-    def requestStatus(self, cmdName):
-        Debug("Handler::requestStatus: {}".format(cmdName))
+    # Ask a device for its TelePeriod, answered by a RESULT {"TelePeriod":N}
+    def queryTelePeriod(self, cmndName):
+        try:
+            self.mqttClient.publish('{}/TelePeriod'.format(cmndName), '')
+        except Exception as e:
+            Domoticz.Error("Handler::queryTelePeriod: {}".format(str(e)))
+
+    # Remember the TelePeriod a device reported, unless it is one we commanded
+    def updateTelePeriod(self, cmndName, seconds):
+        state = self.teleStates.get(cmndName)
+        if state is None or state['period'] is not None:
+            return
         try:
-            topic = '{}/{}'.format(cmdName, "STATUS")
-            self.mqttClient.publish(topic, "")
+            state['device'] = int(seconds)
+        except (TypeError, ValueError):
+            pass
+
+    # Command a TelePeriod, None restores the one the device reported
+    def setTelePeriod(self, cmndName, state, period):
+        state['period'] = period
+        seconds = period or state['device']
+        Debug("Handler::setTelePeriod: {} {}", cmndName, seconds)
+        try:
+            self.mqttClient.publish('{}/TelePeriod'.format(cmndName), str(seconds))
+            metrics.count('tasmoticz_teleperiod_changes_total', 'restored' if period is None else 'lengthened')
         except Exception as e:
-            Domoticz.Error("Handler::requestStatus: {}".format(str(e)))
+            Domoticz.Error("Handler::setTelePeriod: {}".format(str(e)))
+
+    # Different Tasmota devices can have different FullTopic patterns.
+    # All FullTopic patterns we care about are in self.subscriptions (plugin config)
+    # Tasmota devices will be identified by a hex hash from FullTopic without %prefix%
+    # Returns (fullName, cmndName) for a topic without tail or None if it is not one of ours
+    # Results (also negative ones) are cached, so repeated topics are just a dict lookup
+    def resolveTopic(self, head):
+        with self.topicLock:
+            try:
+                self.topicCache.move_to_end(head)
+                return self.topicCache[head]
+            except KeyError:
+                pass
+
+            resolved = self.matchTopic(head.split('/'))
+            self.topicCache[head] = resolved
+            if len(self.topicCache) > self.topicCacheSize:
+                self.topicCache.popitem(last=False)
+            return resolved
+
+    # Identify the subscription that matches our received subtopics
+    def matchTopic(self, subtopics):
+        for patterns in self.patterns:
+            fulltopic = []
+            cmndtopic = []
+            for subtopic, pattern in zip(subtopics, patterns):
+                if((pattern not in ('%topic%', '%prefix%', '+', subtopic)) or
+                    (pattern == '%prefix%' and subtopic != self.prefix[2] and subtopic != self.prefix[3]) or
+                        (pattern == '%topic%' and (subtopic == 'sonoff' or subtopic == 'tasmota'))):
+                    fulltopic = []
+                    break
+                if(pattern != '%prefix%'):
+                    fulltopic.append(subtopic)
+                    cmndtopic.append(subtopic)
+                else:
+                    cmndtopic.append(self.prefix[1])
+            if fulltopic:
+                return '/'.join(fulltopic), '/'.join(cmndtopic)
+        return None
+
+    # Queue a device STATUS request, unless one is already queued or in flight for this device
+    def requestStatus(self, cmdName):
+        if cmdName in self.statusQueue or cmdName in self.statusInFlight:
+            return
+        Debug("Handler::requestStatus: {}", cmdName)
+        self.statusQueue[cmdName] = time.monotonic()
+
+    # Send queued STATUS requests via mqtt as far as the token bucket allows
+    def sendStatusRequests(self):
+        now = time.monotonic()
+        for cmdName, sent in list(self.statusInFlight.items()):
+            if now - sent > self.statusTimeout:
+                Debug("Handler::sendStatusRequests: {} timed out", cmdName)
+                del self.statusInFlight[cmdName]
+
+        self.statusTokens = min(self.statusBurst, self.statusTokens + (now - self.statusRefill) * self.statusRate)
+        self.statusRefill = now
+        while self.statusQueue and self.statusTokens >= 1:
+            cmdName, _ = self.statusQueue.popitem(last=False)
+            self.statusTokens -= 1
+            self.statusInFlight[cmdName] = now
+            try:
+                topic = '{}/{}'.format(cmdName, "STATUS")
+                self.mqttClient.publish(topic, "")
+                if self.groupCommands:
+                    self.mqttClient.publish(topic, "1")
+            except Exception as e:
+                Domoticz.Error("Handler::sendStatusRequests: {}".format(str(e)))
 
 
 ###########################
@@ -187,39 +636,263 @@ def deviceId(deviceName):
     return '{:08X}'.format(binascii.crc32(deviceName.encode('utf8')) & 0xffffffff)
 
 
+# Decoded json Description of our units: unit -> (Description string, decoded dict)
+# Compared by string on every access, so edits in the domoticz UI are noticed
+descriptionCache = {}
+
+# Descriptions are stored as compact json with short keys and a version, e.g. {"v":1,"t":"cmnd/a","c":"POWER",...}
+# Decoded they have the long keys of the legacy format (indented json with long keys), which is still read
+descriptionVersion = 1
+descriptionKeys = {'Topic': 't', 'Command': 'c', 'Device': 'd', 'Type': 'y', 'Name': 'n'}
+descriptionNames = {short: key for key, short in descriptionKeys.items()}
+
+
+def encodeDescription(description):
+    encoded = {'v': descriptionVersion}
+    for key, value in description.items():
+        encoded[descriptionKeys.get(key, key)] = value
+    return json.dumps(encoded, ensure_ascii=False, separators=(',', ':'))
+
+
+def decodeDescription(raw):
+    decoded = json.loads(raw)
+    if 'v' not in decoded:
+        return decoded
+    return {descriptionNames.get(key, key): value for key, value in decoded.items() if key != 'v'}
+
+
+# Returns the decoded Description of a unit, only parses json if it changed. Raises if not ours
+# Don't modify the returned dict, use a copy and updateDescription()
+def getDescription(idx):
+    raw = Devices[idx].Description
+    cached = descriptionCache.get(idx)
+    if cached is not None and cached[0] == raw:
+        return cached[1]
+    description = decodeDescription(raw)
+    descriptionCache[idx] = (raw, description)
+    if cached is not None and cached[1].get('Command') != description.get('Command'):
+        unindexUnit(idx)
+        indexUnit(idx)
+    return description
+
+
+# Write a changed Description of a unit to domoticz and the cache
+def updateDescription(idx, description, **kwargs):
+    raw = encodeDescription(description)
+    Devices[idx].Update(nValue=Devices[idx].nValue, sValue=Devices[idx].sValue,
+        Description=raw, SuppressTriggers=True, **kwargs)
+    descriptionCache[idx] = (raw, description)
+
+
+# Tasmota Module and Version per DeviceID hash: {"m": module, "v": version}
+# Kept in the plugin configuration of domoticz, not in the Description of each unit.
+# Domoticz versions without one keep them in the Descriptions (deviceInfosSaved is False)
+deviceInfos = {}
+deviceInfosSaved = None
+
+
+def loadDeviceInfos():
+    deviceInfos.clear()
+    deviceInfos.update(loadConfiguration('Devices', {}))
+
+
+# Returns False if the plugin configuration can't be written
+def saveDeviceInfos():
+    global deviceInfosSaved
+    saved = saveConfiguration('Devices', deviceInfos)
+    if not saved and deviceInfosSaved is not False:
+        Domoticz.Log("tasmota::saveDeviceInfos: Plugin configuration can't be written, "
+                     "Module and Version stay in the Descriptions of the units")
+    deviceInfosSaved = saved
+    return saved
+
+
+# Without a plugin configuration: write Module and Version of a device into the Descriptions of its units
+def describeDeviceInfo(deviceHash, info):
+    for idx in deviceIndex.get(deviceHash, ()):
+        if idx not in Devices:
+            continue
+        description = dict(getDescription(idx))
+        if description.get('Module') != info['m'] or description.get('Version') != info['v']:
+            description['Module'] = info['m']
+            description['Version'] = info['v']
+            updateDescription(idx, description)
+
+
+# Value of key in the plugin configuration of domoticz, default if there is none
+def loadConfiguration(key, default):
+    try:
+        return Domoticz.Configuration().get(key, default)
+    except Exception as e:
+        Debug("tasmota::loadConfiguration: No plugin configuration: {}", e)
+        return default
+
+
+# Returns False if the plugin configuration can't be written
+def saveConfiguration(key, value):
+    try:
+        config = Domoticz.Configuration()
+        config[key] = value
+        Domoticz.Configuration(config)
+        return True
+    except Exception as e:
+        Debug("tasmota::saveConfiguration: No plugin configuration: {}", e)
+        return False
+
+
+# One time rewrite of legacy Descriptions in the compact format, Module and Version move to deviceInfos
+# Skipped while they can't be saved in the plugin configuration, so they are not lost
+def migrateDescriptions():
+    legacy = []
+    for idx in list(Devices):
+        try:
+            description = dict(getDescription(idx))
+        except Exception:
+            continue
+        if 'Command' not in description or (Devices[idx].Description.startswith('{"v":') and
+                                            'Module' not in description and 'Version' not in description):
+            continue
+        module = description.pop('Module', None)
+        version = description.pop('Version', None)
+        if module is not None or version is not None:
+            deviceInfos.setdefault(Devices[idx].DeviceID, {'m': module, 'v': version})
+        legacy.append((idx, description))
+    if not legacy:
+        return
+    if not saveDeviceInfos():
+        Debug("tasmota::migrateDescriptions: No plugin configuration, {} Descriptions kept", len(legacy))
+        return
+    for idx, description in legacy:
+        updateDescription(idx, description)
+    Domoticz.Log("tasmota::migrateDescriptions: {} units migrated".format(len(legacy)))
+
+
+# Index of our domoticz units, so messages don't need to scan all Devices
+# unitIndex:   (DeviceID hash, Command) -> unit
+# deviceIndex: DeviceID hash -> set of units
+# unitTypes:   unit -> (Type, SubType), so values can be converted without Devices (see prepareValues())
+# deviceTopics: DeviceID hash -> cmndName (Topic of its units)
+unitIndex = {}
+deviceIndex = {}
+unitTypes = {}
+deviceTopics = {}
+
+
+# Add a domoticz unit to the index (ignores units without our json Description)
+def indexUnit(idx):
+    try:
+        deviceHash = Devices[idx].DeviceID
+        description = getDescription(idx)
+        command = description['Command']
+    except:
+        return
+    unitTypes[idx] = (Devices[idx].Type, Devices[idx].SubType)
+    unitIndex[(deviceHash, command)] = idx
+    deviceIndex.setdefault(deviceHash, set()).add(idx)
+    if 'Topic' in description:
+        deviceTopics[deviceHash] = description['Topic']
+    if idx not in lastWrites:
+        seedLastWrite(idx)
+
+
+# Remove a domoticz unit from the index and make it available for new devices
+def unindexUnit(idx):
+    releaseUnit(idx)
+    for cache in (descriptionCache, unitTypes, pendingUpdates, bandValues, suppressedValues, lastWrites, lastSeen,
+                  keepaliveDue, unconfirmed):
+        cache.pop(idx, None)
+    keepaliveStaggered.discard(idx)
+    for key in [key for key, unit in unitIndex.items() if unit == idx]:
+        del unitIndex[key]
+    for deviceHash in list(deviceIndex):
+        deviceIndex[deviceHash].discard(idx)
+        if not deviceIndex[deviceHash]:
+            del deviceIndex[deviceHash]
+            deviceTopics.pop(deviceHash, None)
+
+
+# (Re)build the index from all existing domoticz units. Only done once on startup
+def buildIndex():
+    unitIndex.clear()
+    deviceIndex.clear()
+    deviceTopics.clear()
+    descriptionCache.clear()
+    for idx in Devices:
+        indexUnit(idx)
+
+    freeUnits[:] = [idx for idx in range(1, maxUnit + 1) if idx not in Devices]
+    heapq.heapify(freeUnits)
+    Debug('tasmota::buildIndex: {} units of {} devices', len(unitIndex), len(deviceIndex))
+
+
+# Unit numbers not used by domoticz devices of this plugin as heap, so the lowest is reused first
+freeUnits = []
+maxUnit = 511
+unitsExhausted = False
+
+
+# Returns a free unit number for a new domoticz device or None if all are used
+def allocateUnit():
+    global unitsExhausted
+    while freeUnits:
+        idx = heapq.heappop(freeUnits)
+        if idx not in Devices:
+            unitsExhausted = False
+            return idx
+    if not unitsExhausted:
+        Domoticz.Error("tasmota::allocateUnit: All {} units are used, no more devices can be created".format(maxUnit))
+        unitsExhausted = True
+    return None
+
+
+# Return a unit number to the free list if its device is gone (removed or failed to create)
+def releaseUnit(idx):
+    if idx not in Devices and 0 < idx <= maxUnit and idx not in freeUnits:
+        heapq.heappush(freeUnits, idx)
+
+
 # Collects a list of unit ids of all domoticz devices refering to the same tasmota device
 def findDevices(fullName):
-    idxs = []
-    deviceHash = deviceId(fullName)
-    for device in Devices:
-        if Devices[device].DeviceID == deviceHash:
-            idxs.append(device)
-
-    Debug('tasmota::findDevices: fullName: {}, Idxs {}'.format(fullName, repr(idxs)))
+    idxs = sorted(idx for idx in deviceIndex.get(deviceId(fullName), ()) if idx in Devices)
+    Debug('tasmota::findDevices: fullName: {}, Idxs {!r}', fullName, idxs)
     return idxs
 
 
+# Registry of supported tasmota attributes, built once on import
+
+# Tasmota relays, the only STATE attributes that become domoticz devices (switches)
+powerAttrs = frozenset(['POWER'] + ['POWER{}'.format(r) for r in range(1, 33)])
+
+# Supported attributes of tasmota tele STATE messages (and of their Wifi object)
+stateAttrs = ('POWER', 'Heap', 'LoadAvg') + tuple('POWER{}'.format(r) for r in range(1, 33))
+wifiAttrs = ('RSSI',)
+
+# Diagnostic STATE attributes that change with every message
+teleNoise = frozenset(['Heap', 'LoadAvg', 'RSSI'])
+
+# Friendly names that are tasmota defaults and not worth using as domoticz device names
+noNames = frozenset(['Sonoff', 'Tasmota', '', None] + ['Tasmota{}'.format(r) for r in range(2, 9)])
+
+
 # Collects a list of all supported attribute key/value pairs from tasmota tele STATE messages
 def getStateDevices(message):
     states = []
-    for attr in ['POWER', 'Heap', 'LoadAvg'] + ['POWER{}'.format(r) for r in range(1, 33)]:
-        try:
-            value = message[attr]
-            states.append((attr, value))
-        except:
-            pass
-
-    wifiattrs = ['RSSI']
-    for attr in wifiattrs:
-        try:
-            value = message['Wifi'][attr]
-            states.append((attr, value))
-        except:
-            pass
+    if not isinstance(message, collections.Mapping):
+        return states
+
+    for attr in stateAttrs:
+        if attr in message:
+            states.append((attr, message[attr]))
+
+    wifi = message.get('Wifi')
+    if isinstance(wifi, collections.Mapping):
+        for attr in wifiAttrs:
+            if attr in wifi:
+                states.append((attr, wifi[attr]))
     return states
 
 
-# Collects a list of all supported attribute sensor/type/value tuples from tasmota tele SENSOR messages
+# Supported types of values in tasmota tele SENSOR messages
 # * One sensor can contain several types (e.g. DHT11 has Temperature and Humidity)
 # * Additional desc contains info needed to create a matching domoticz device
 #  * Name is used for display / translation
@@ -227,63 +900,169 @@ def getStateDevices(message):
 #  * Valid DomoType strings can be found in maptypename(): https://github.com/domoticz/domoticz/blob/development/hardware/plugins/PythonObjects.cpp#L371
 #  * If there is no DomoType TypeName matching the sensor type, use a tuple of domoticz Type;Subtype;Switchtype
 
+typeDb = {name: MappingProxyType(desc) for name, desc in {
+    'Temperature':   {'Name': 'Temperatur',      'Unit': '°C',   'DomoType': 'Temperature'},
+    'Humidity':      {'Name': 'Feuchtigkeit',    'Unit': '%',    'DomoType': 'Humidity'},
+    'Pressure':      {'Name': 'Luftdruck',       'Unit': 'hPa',  'DomoType': 'Barometer'},
+    'Illuminance':   {'Name': 'Helligkeit',      'Unit': 'lux',  'DomoType': 'Illumination'},
+    'Distance':      {'Name': 'Abstand',         'Unit': 'mm ',  'DomoType': 'Distance'},
+    'UvLevel':       {'Name': 'UV Level',        'Unit': 'raw',  'DomoType': 'Custom'},
+    'UvIndex':       {'Name': 'UV Index',        'Unit': 'UVI',  'DomoType': 'Custom'},
+    'UvPower':       {'Name': 'UV Leistung',     'Unit': 'W/m²', 'DomoType': 'Custom'},
+    'Total':         {'Name': 'Gesamt',          'Unit': 'kWh',  'DomoType': '113;0;0'},
+    'Yesterday':     {'Name': 'Gestern',         'Unit': 'kWh',  'DomoType': 'Custom'},
+    'Today':         {'Name': 'Heute',           'Unit': 'kWh',  'DomoType': 'Custom'},
+    'Power':         {'Name': 'Leistung',        'Unit': 'kW',   'DomoType': 'Usage'},
+    'ApparentPower': {'Name': 'Scheinleistung',  'Unit': 'kW',   'DomoType': 'Usage'},
+    'ReactivePower': {'Name': 'Blindleistung',   'Unit': 'kW',   'DomoType': 'Usage'},
+    'Factor':        {'Name': 'Leistungsfaktor', 'Unit': 'W/VA', 'DomoType': 'Custom'},
+    'Frequency':     {'Name': 'Frequenz',        'Unit': 'Hz',   'DomoType': 'Custom'},
+    'Voltage':       {'Name': 'Spannung',        'Unit': 'V',    'DomoType': 'Voltage'},
+    'Current':       {'Name': 'Strom',           'Unit': 'A',    'DomoType': 'Current (Single)'},
+    'zählerstand_total':     {'Name':'Total Usage',  'Unit':'KWh', 'DomoType': '113;0;0'},
+    'zählerstand_tarif_1':   {'Name':'Tarif1 Usage', 'Unit':'KWh', 'DomoType': '113;0;0'},
+    'zählerstand_tarif_2':   {'Name':'Tarif2 Usage', 'Unit':'KWh', 'DomoType': '113;0;0'},
+    'aktuelle_wirkleistung': {'Name': 'Usage Total', 'Unit':' W',  'DomoType': 'Usage'},
+    'wirkleistung_l1':       {'Name': 'Usage l1',    'Unit':' W',  'DomoType': 'Usage'},
+    'wirkleistung_l2':       {'Name': 'Usage l2',    'Unit':' W',  'DomoType': 'Usage'},
+    'wirkleistung_l3':       {'Name': 'Usage l3',    'Unit':' W',  'DomoType': 'Usage'},
+    # Combined types, see combineValues(). Parts are the attrs of units they replace
+    'TempHumBaro':   {'Name': 'Temperatur/Feuchtigkeit/Luftdruck', 'Unit': '', 'DomoType': 'Temp+Hum+Baro',
+                      'Parts': ('{}-Temperature', '{}-Humidity', '{}-Pressure', '{}-TempHum')},
+    'TempHum':       {'Name': 'Temperatur/Feuchtigkeit', 'Unit': '', 'DomoType': 'Temp+Hum',
+                      'Parts': ('{}-Temperature', '{}-Humidity')},
+    'Current3':      {'Name': 'Strom L1-L3', 'Unit': 'A', 'DomoType': 'Current/Ampere',
+                      'Parts': ('{}-1-Current', '{}-2-Current', '{}-3-Current')},
+}.items()}
+
+# With the CombineSensors setting, values of a sensor are written to one combined unit (see combineValues())
+combineSensors = False
+combinedTypes = (('TempHumBaro', ('Temperature', 'Humidity', 'Pressure')), ('TempHum', ('Temperature', 'Humidity')))
+phaseTypes = {'Current': 'Current3'}
+# Sensor types of the values in a combined value, for their dead-bands
+combinedParts = dict(combinedTypes)
+combinedParts.update((combined, (type,) * 3) for type, combined in phaseTypes.items())
+
+
+# Add sensor types not (yet) supported above, e.g. from the SensorTypes setting:
+# {"CarbonDioxide": {"Name": "CO2", "Unit": "ppm", "DomoType": "Custom"}}
+def addSensorTypes(types):
+    for name, desc in types.items():
+        if not all(key in desc for key in ('Name', 'Unit', 'DomoType')):
+            Domoticz.Error("tasmota::addSensorTypes: {} needs Name, Unit and DomoType".format(name))
+            continue
+        typeDb[name] = MappingProxyType(dict(desc))
+
+
+# Collects a list of all supported attribute sensor/type/value/desc tuples from tasmota tele SENSOR messages
 def getSensorDevices(message):
     states = []
 
-    typeDb = {
-        'Temperature':   {'Name': 'Temperatur',      'Unit': '°C',   'DomoType': 'Temperature'},
-        'Humidity':      {'Name': 'Feuchtigkeit',    'Unit': '%',    'DomoType': 'Humidity'},
-        'Pressure':      {'Name': 'Luftdruck',       'Unit': 'hPa',  'DomoType': 'Barometer'},
-        'Illuminance':   {'Name': 'Helligkeit',      'Unit': 'lux',  'DomoType': 'Illumination'},
-        'Distance':      {'Name': 'Abstand',         'Unit': 'mm ',  'DomoType': 'Distance'},
-        'UvLevel':       {'Name': 'UV Level',        'Unit': 'raw',  'DomoType': 'Custom'},
-        'UvIndex':       {'Name': 'UV Index',        'Unit': 'UVI',  'DomoType': 'Custom'},
-        'UvPower':       {'Name': 'UV Leistung',     'Unit': 'W/m²', 'DomoType': 'Custom'},
-        'Total':         {'Name': 'Gesamt',          'Unit': 'kWh',  'DomoType': '113;0;0'},
-        'Yesterday':     {'Name': 'Gestern',         'Unit': 'kWh',  'DomoType': 'Custom'},
-        'Today':         {'Name': 'Heute',           'Unit': 'kWh',  'DomoType': 'Custom'},
-        'Power':         {'Name': 'Leistung',        'Unit': 'kW',   'DomoType': 'Usage'},
-        'ApparentPower': {'Name': 'Scheinleistung',  'Unit': 'kW',   'DomoType': 'Usage'},
-        'ReactivePower': {'Name': 'Blindleistung',   'Unit': 'kW',   'DomoType': 'Usage'},
-        'Factor':        {'Name': 'Leistungsfaktor', 'Unit': 'W/VA', 'DomoType': 'Custom'},
-        'Frequency':     {'Name': 'Frequenz',        'Unit': 'Hz',   'DomoType': 'Custom'},
-        'Voltage':       {'Name': 'Spannung',        'Unit': 'V',    'DomoType': 'Voltage'},
-        'Current':       {'Name': 'Strom',           'Unit': 'A',    'DomoType': 'Current (Single)'},
-        'zählerstand_total':     {'Name':'Total Usage',  'Unit':'KWh', 'DomoType': '113;0;0'},
-        'zählerstand_tarif_1':   {'Name':'Tarif1 Usage', 'Unit':'KWh', 'DomoType': '113;0;0'},
-        'zählerstand_tarif_2':   {'Name':'Tarif2 Usage', 'Unit':'KWh', 'DomoType': '113;0;0'},
-        'aktuelle_wirkleistung': {'Name': 'Usage Total', 'Unit':' W',  'DomoType': 'Usage'},
-        'wirkleistung_l1':       {'Name': 'Usage l1',    'Unit':' W',  'DomoType': 'Usage'},
-        'wirkleistung_l2':       {'Name': 'Usage l2',    'Unit':' W',  'DomoType': 'Usage'},
-        'wirkleistung_l3':       {'Name': 'Usage l3',    'Unit':' W',  'DomoType': 'Usage'}
-    }
-
     if isinstance(message, collections.Mapping):
         for sensor, sensorData in message.items():
             if isinstance(sensorData, collections.Mapping):
                 for type, value in sensorData.items():
                     if type in typeDb and value is not None:
-                        desc = typeDb[type].copy()
-                        desc['Sensor'] = sensor
-                        if sensor == 'ENERGY':
-                            desc['Sensor'] = 'Energie'
-                        states.append((sensor, type, value, desc))
+                        states.append((sensor, type, value, typeDb[type]))
 
     return states
 
 
+# Collects a list of attr/value/sensor/desc tuples from tasmota tele SENSOR messages
+# attr identifies a single value, e.g. ENERGY-Power or ENERGY-2-Voltage if a sensor reports a list of values
+def getSensorValues(message):
+    values = []
+    #   ENERGY, Voltage, 220 {Name: Spannung, Unit: V}
+    for sensor, type, items, desc in getSensorDevices(message):
+        # Check if sensor reports more than one value (e.g. dual energy meter)
+        if not isinstance(items, list):
+            values.append(('{}-{}'.format(sensor, type), items, sensor, desc))
+        elif len(items) == 1:
+            values.append(('{}-{}'.format(sensor, type), items[0], sensor, desc))
+        elif combineSensors and len(items) == 3 and type in phaseTypes:
+            values.append(('{}-{}'.format(sensor, phaseTypes[type]), tuple(items), sensor, typeDb[phaseTypes[type]]))
+        else:
+            for i, value in enumerate(items):
+                values.append(('{}-{}-{}'.format(sensor, i+1, type), value, sensor, desc))
+    if combineSensors:
+        values = combineValues(values)
+    return values
+
+
+# Replace Temperature, Humidity (and Pressure) values of a sensor by one value (a tuple) for a combined unit
+def combineValues(values):
+    index = {attr: i for i, (attr, _, _, _) in enumerate(values)}
+    combined = []
+    removed = set()
+    for sensor in {sensor for _, _, sensor, _ in values}:
+        for combinedType, types in combinedTypes:
+            attrs = ['{}-{}'.format(sensor, type) for type in types]
+            if all(attr in index for attr in attrs):
+                removed.update(index[attr] for attr in attrs)
+                combined.append(('{}-{}'.format(sensor, combinedType), tuple(values[index[attr]][1] for attr in attrs),
+                                 sensor, typeDb[combinedType]))
+                break
+    if not combined:
+        return values
+    return [value for i, value in enumerate(values) if i not in removed] + combined
+
+
+# Looks up units of attr/value/sensor/desc tuples and converts their values if the unit is known
+# Does not access Devices, so it can run on worker threads
+# Returns a list of attr/value/sensor/desc/idx/converted tuples, idx and converted are None for new units
+def prepareValues(fullName, values):
+    deviceHash = deviceId(fullName)
+    prepared = []
+    for attr, value, sensor, desc in values:
+        idx = unitIndex.get((deviceHash, attr))
+        converted = None
+        types = unitTypes.get(idx)
+        if types is not None:
+            try:
+                converted = t2d(attr, value, types[0], types[1])
+            except Exception:
+                pass
+        prepared.append((attr, value, sensor, desc, idx, converted))
+    return prepared
+
+
 # Find the domoticz device unit id matching a STATE or SENSOR attribute coming from tasmota
-def deviceByAttr(idxs, attr):
-    for idx in idxs:
-        try:
-            description = json.loads(Devices[idx].Description)
-            if description['Command'] == attr:
-                return idx
-        except:
-            pass
+def deviceByAttr(deviceHash, attr):
+    idx = unitIndex.get((deviceHash, attr))
+    if idx is None:
+        return None
+    if idx not in Devices:
+        # Unit was deleted without us noticing
+        unindexUnit(idx)
+        return None
+    try:
+        # Reindexes the unit if its Description was edited
+        if getDescription(idx)['Command'] == attr:
+            return idx
+    except:
+        unindexUnit(idx)
     return None
 
 
+# True if attr of sensor is a part of a combined unit of the device, e.g. a message without Humidity
+# must not create or update a separate Temperature unit next to the Temp+Hum unit
+def replacedByCombined(deviceHash, attr, sensor):
+    for combined in combinedParts:
+        if (deviceHash, '{}-{}'.format(sensor, combined)) in unitIndex and \
+                attr in (part.format(sensor) for part in typeDb[combined]['Parts']):
+            return True
+    return False
+
+
+# Hide units replaced by a combined unit. They keep their history and can be deleted in domoticz
+def retireUnits(deviceHash, attrs):
+    for attr in attrs:
+        idx = deviceByAttr(deviceHash, attr)
+        if idx is not None and Devices[idx].Used:
+            Domoticz.Log("tasmota::retireUnits: idx: {}, name: {} replaced by combined unit".format(idx, Devices[idx].Name))
+            Devices[idx].Update(nValue=Devices[idx].nValue, sValue=Devices[idx].sValue, Used=0, SuppressTriggers=True)
+
+
 # Some domoticz device Create(), Update() and query value examples
 #
 #  Domoticz.Device(Name=unitname, Unit=iUnit,TypeName="Switch",Used=1,DeviceID=unitname).Create()
@@ -310,11 +1089,10 @@ def createStateDevice(fullName, cmndName, deviceAttr):
     Description contains necessary info as json (previously used Options, but got overwritten for Custom devices)
     '''
 
-    for idx in range(1, 512):
-        if idx not in Devices:
-            break
-
-    if deviceAttr in ['POWER'] + ['POWER{}'.format(r) for r in range(1, 33)]:
+    if deviceAttr in powerAttrs:
+        idx = allocateUnit()
+        if idx is None:
+            return None
         deviceHash = deviceId(fullName)
         deviceName = '{} {}'.format(fullName, deviceAttr)
         description = {'Topic': cmndName, 'Command': deviceAttr, 'Device': 'Schalter'}
@@ -323,31 +1101,35 @@ def createStateDevice(fullName, cmndName, deviceAttr):
         else:
             description["Type"] = deviceAttr[5:]
         Domoticz.Device(Name=deviceName, Unit=idx, TypeName="Switch", Used=1,
-                        Description=json.dumps(description, indent=2, ensure_ascii=False), DeviceID=deviceHash).Create()
+                        Description=encodeDescription(description), DeviceID=deviceHash).Create()
         if idx in Devices:
             # Remove hardware/plugin name from domoticz device name
             Devices[idx].Update(
                 nValue=Devices[idx].nValue, sValue=Devices[idx].sValue, Name=deviceName, SuppressTriggers=True)
+            indexUnit(idx)
+            metrics.count('tasmoticz_devices_created_total')
             Domoticz.Log("tasmota::createStateDevice: ID: {}, Name: {}, On: {}, Hash: {}".format(
                 idx, deviceName, fullName, deviceHash))
             return idx
         Domoticz.Error("tasmota::createStateDevice: Failed creating Device ID: {}, Name: {}, On: {}".format(
             idx, deviceName, fullName))
+        releaseUnit(idx)
 
     return None
 
 
 # Create a domoticz device from infos extracted out of tasmota SENSOR tele messages
-def createSensorDevice(fullName, cmndName, deviceAttr, desc):
+def createSensorDevice(fullName, cmndName, deviceAttr, sensor, desc):
     '''
     Create domoticz sensor device for deviceName
     DeviceID is hash of fullName
+    sensor is the name of the sensor in the SENSOR message, it may contain '-' (e.g. AM2301-14)
     Description contains necessary info as json (previously used Options, but got overwritten for Custom devices)
     '''
 
-    for idx in range(1, 512):
-        if idx not in Devices:
-            break
+    idx = allocateUnit()
+    if idx is None:
+        return None
 
     deviceHash = deviceId(fullName)
     attrs = deviceAttr.split('-')
@@ -359,7 +1141,7 @@ def createSensorDevice(fullName, cmndName, deviceAttr, desc):
     description = {'Topic': cmndName, 'Command': deviceAttr,
                    'Device': desc['Sensor'], 'Type': desc['Name']}
 
-    if desc['DomoType'][0] == 'Custom':
+    if desc['DomoType'] == 'Custom':
         options = {'Custom': '1;{}'.format(desc['Unit'])}
     else:
         options = None
@@ -367,29 +1149,34 @@ def createSensorDevice(fullName, cmndName, deviceAttr, desc):
     if not desc['DomoType'][:1].isdigit():
         # Create device that has a TypeName (prefered by domoticz)
         Domoticz.Device(Name=deviceName, Unit=idx, TypeName=desc['DomoType'], Used=1, Options=options,
-            Description=json.dumps(description, indent=2, ensure_ascii=False), DeviceID=deviceHash).Create()
+            Description=encodeDescription(description), DeviceID=deviceHash).Create()
     else:
         # Create device without TypeName using domoticz low level Type, Subtype and Switchtype
         dtype, dsub, dswitch = desc['DomoType'].split(";")
         Domoticz.Device(Name=deviceName, Unit=idx, Type=int(dtype), Subtype=int(dsub), Switchtype=int(dswitch), Used=1, Options=options,
-            Description=json.dumps(description, indent=2, ensure_ascii=False), DeviceID=deviceHash).Create()
+            Description=encodeDescription(description), DeviceID=deviceHash).Create()
 
     if idx in Devices:
         # Remove hardware/plugin name from domoticz device name
         Devices[idx].Update(
             nValue=Devices[idx].nValue, sValue=Devices[idx].sValue, Name=deviceName, SuppressTriggers=True)
+        indexUnit(idx)
+        metrics.count('tasmoticz_devices_created_total')
         Domoticz.Log("tasmota::createSensorDevice: ID: {}, Name: {}, On: {}, Hash: {}, Type: {}".format(
             idx, deviceName, fullName, deviceHash, desc['DomoType']))
+        if 'Parts' in desc:
+            retireUnits(deviceHash, [part.format(sensor) for part in desc['Parts']])
         return idx
 
     Domoticz.Error("tasmota::createSensorDevice: Failed creating Device ID: {}, Name: {}, On: {}, Type: {}".format(
         idx, deviceName, fullName, desc['DomoType']))
+    releaseUnit(idx)
     return None
 
 
 # Translate device value received form domoticz to tasmota attribute/value
 def d2t(attr, value):
-    if attr in ['POWER'] + ['POWER{}'.format(r) for r in range(1, 33)]:
+    if attr in powerAttrs:
         if value == "On":
             return "on"
         elif value == "Off":
@@ -397,102 +1184,322 @@ def d2t(attr, value):
     return None
 
 
+# Converters of tasmota values to domoticz (nValue, sValue) by domoticz (Type, Subtype) or Type
+
+def humidityValue(value):
+    # Domoticz humidity only accepted as integer
+    return int(round(float(value))), "0"
+
+
+def barometerValue(value):
+    # Domoticz barometer needs nValue=0 and sValue="pressure;5"
+    return 0, "{};5".format(value)
+
+
+def distanceValue(value):
+    # Domoticz distance needs cm but gets mm
+    return 0, str(float(value)/10)
+
+
+def counterValue(value):
+    # Energy, water and gas counters expected in Wh or l but come in as kWh or m³
+    return 0, str(value * 1000)
+
+
+def defaultValue(value):
+    return 0, str(value)
+
+
+# Domoticz humidity status: 0 normal, 1 comfortable, 2 dry, 3 wet
+def humidityStatus(humidity):
+    if humidity < 30:
+        return 2
+    if humidity > 70:
+        return 3
+    if 40 <= humidity <= 60:
+        return 1
+    return 0
+
+
+def tempHumValue(value):
+    temperature, humidity = value
+    humidity = int(round(float(humidity)))
+    return 0, "{};{};{}".format(temperature, humidity, humidityStatus(humidity))
+
+
+def tempHumBaroValue(value):
+    temperature, humidity, pressure = value
+    humidity = int(round(float(humidity)))
+    # Forecast 5: unknown
+    return 0, "{};{};{};{};5".format(temperature, humidity, humidityStatus(humidity), pressure)
+
+
+def phasesValue(value):
+    return 0, ';'.join(str(phase) for phase in value)
+
+
+converters = {
+    81: humidityValue,
+    82: tempHumValue,
+    84: tempHumBaroValue,
+    89: phasesValue,
+    (243, 26): barometerValue,
+    (243, 27): distanceValue,
+    (113, 0): counterValue,
+    (113, 1): counterValue,
+    (113, 2): counterValue,
+    (113, 4): counterValue,
+}
+
+powerValues = MappingProxyType({"ON": (1, "On"), "OFF": (0, "Off")})
+
+
 # Translate values of a tasmota attribute to matching domoticz device value
 def t2d(attr, value, type, subtype):
-    if attr in ['POWER'] + ['POWER{}'.format(r) for r in range(1, 33)]:
-        if value == "ON":
-            return 1, "On"
-        elif value == "OFF":
-            return 0, "Off"
-
-    elif type == 81:
-        # Domoticz humidity only accepted as integer
-        return int(round(float(value))), "0"
-
-    elif type == 243:
-        if subtype == 26:
-            # Domoticz barometer needs nValue=0 and sValue="pressure;5"
-            return 0, "{};5".format(value)
-        if subtype == 27:
-            # Domoticz distance needs cm but gets mm
-            return 0, str(float(value)/10)
-
-    elif type == 113 and subtype in [0, 1, 2, 4]:
-        # Energy, water and gas counters expected in Wh or l but come in as kWh or m³
-        value = value * 1000
+    if attr in powerAttrs:
+        return powerValues.get(value) or defaultValue(value)
+    converter = converters.get((type, subtype)) or converters.get(type, defaultValue)
+    return converter(value)
+
+
+# Time of the last value write per unit on the monotonic clock, for the hourly keepalive write
+lastWrites = {}
+keepaliveInterval = 59 * 60
+# Time a value for a unit was last received. Units of silent devices are not kept alive
+lastSeen = {}
+# Keepalive deadlines as heap of (deadline, unit). Only the entry matching keepaliveDue[unit] is valid
+keepaliveHeap = []
+keepaliveDue = {}
+# Units whose first keepalive is still due
+keepaliveStaggered = set()
+
+
+# Convert the LastUpdate of a unit to the monotonic clock. Only done once per unit (created or at start)
+def seedLastWrite(idx):
+    now = time.monotonic()
+    try:
+        age = time.time() - time.mktime(time.strptime(Devices[idx].LastUpdate, '%Y-%m-%d %H:%M:%S'))
+    except Exception:
+        age = 0
+    lastWrites[idx] = now - max(age, 0)
+    keepaliveStaggered.add(idx)
+
+
+# Keepalive deadline of a unit: keepaliveInterval after its last write
+# Until the first keepalive of a unit it is between half and the full interval, spread evenly over the units,
+# so units written together don't refresh together
+def keepaliveDeadline(idx):
+    if idx in keepaliveStaggered:
+        return lastWrites[idx] + keepaliveInterval * (0.5 + 0.5 * (idx * 0.6180339887 % 1))
+    return lastWrites[idx] + keepaliveInterval
+
+
+def scheduleKeepalive(idx):
+    deadline = keepaliveDeadline(idx)
+    keepaliveDue[idx] = deadline
+    heapq.heappush(keepaliveHeap, (deadline, idx))
+
+
+# Rewrite the latest value (also if suppressed) of units that are due, on heartbeat
+# Units written since they were scheduled are rescheduled, units without received values since are dropped
+def refreshKeepalives():
+    now = time.monotonic()
+    while keepaliveHeap and keepaliveHeap[0][0] <= now:
+        deadline, idx = heapq.heappop(keepaliveHeap)
+        if keepaliveDue.get(idx) != deadline:
+            continue
+        if idx not in Devices or idx not in lastWrites:
+            del keepaliveDue[idx]
+            continue
+        if keepaliveDeadline(idx) > now or idx in pendingUpdates:
+            scheduleKeepalive(idx)
+            continue
+        if lastSeen.get(idx, 0) <= lastWrites[idx]:
+            # Silent device: let domoticz show its timeout, updateValue() schedules it again
+            del keepaliveDue[idx]
+            continue
+        suppressed = suppressedValues.pop(idx, None)
+        if suppressed is None:
+            nValue, sValue = Devices[idx].nValue, Devices[idx].sValue
+        else:
+            # The written value is the reference of the dead-band from now on
+            nValue, sValue, bandValues[idx] = suppressed
+        Debug("tasmota::refreshKeepalives: Idx:{}, nValue: {}, sValue: {}", idx, nValue, sValue)
+        Devices[idx].Update(nValue=nValue, sValue=sValue)
+        lastWrites[idx] = now
+        keepaliveStaggered.discard(idx)
+        metrics.count('tasmoticz_updates_total')
+        metrics.count('tasmoticz_keepalives_total')
+        scheduleKeepalive(idx)
+
+
+# Write-behind buffer of domoticz updates: unit -> latest (nValue, sValue) not yet written
+# Written by flushUpdates() on heartbeat or when the oldest entry waits longer than updateDelay seconds
+pendingUpdates = OrderedDict()
+pendingSince = 0
+updateDelay = 10
+
+
+# Write all buffered values to their domoticz devices
+def flushUpdates():
+    while pendingUpdates:
+        idx, (nValue, sValue) = pendingUpdates.popitem(last=False)
+        if idx in Devices:
+            Debug("tasmota::flushUpdates: Idx:{}, nValue: {}, sValue: {}", idx, nValue, sValue)
+            Devices[idx].Update(nValue=nValue, sValue=sValue)
+            lastWrites[idx] = time.monotonic()
+            metrics.count('tasmoticz_updates_total')
+
+
+# Dead-bands per sensor type (keys of typeDb), e.g. {"Temperature": {"Absolute": 0.2}, "Power": {"Relative": 0.01}}
+# Changes within a dead-band are not written, see suppressedByDeadBand()
+deadBands = {}
+# Value last written (or buffered) per unit with a dead-band: reference for the next change
+bandValues = {}
+# Latest value per unit that was suppressed by its dead-band: unit -> (nValue, sValue, band value)
+suppressedValues = {}
+
+
+# Returns True if value changed less than the dead-band of its sensor type since the last written value
+# Otherwise value becomes the new reference
+# Values of combined units are compared one by one, each with the band of its type (unchanged without one)
+def suppressedByDeadBand(idx, attr, value):
+    types = bandTypes(attr)
+    bands = [deadBands.get(type) for type in types]
+    if not any(bands):
+        return False
+    values = bandValue(attr, value)
+    if values is None:
+        return False
+    last = bandValues.get(idx)
+    if last is not None and len(last) == len(values) and all(
+            withinBand(band, part, lastPart) for band, part, lastPart in zip(bands, values, last)):
+        return True
+    bandValues[idx] = values
+    return False
 
-    return 0, str(value)
+
+# Sensor types of the value(s) of attr
+def bandTypes(attr):
+    type = attr.rsplit('-', 1)[-1]
+    return combinedParts.get(type, (type,))
+
+
+# value as tuple of floats for the dead-band comparison, None if it is not numeric
+def bandValue(attr, value):
+    if attr.rsplit('-', 1)[-1] not in combinedParts:
+        value = (value,)
+    try:
+        return tuple(float(part) for part in value)
+    except (TypeError, ValueError):
+        return None
+
+
+def withinBand(band, value, last):
+    delta = abs(value - last)
+    if band is None:
+        return delta == 0
+    return delta <= band.get('Absolute', 0) or delta <= abs(last) * band.get('Relative', 0)
 
 
 # Update a tasmota attributes value in its associated domoticz device idx
-def updateValue(idx, attr, value):
-    nValue, sValue = t2d(attr, value, Devices[idx].Type, Devices[idx].SubType)
-    Debug(Devices[idx].LastUpdate)
-    lastupdate = datetime.fromtimestamp(time.mktime(time.strptime(Devices[idx].LastUpdate, '%Y-%m-%d %H:%M:%S')))
-    currenttime = datetime.now()
+# Switch states are written immediately, other values go through the write-behind buffer
+# converted is the (nValue, sValue) of value if already known
+def updateValue(idx, attr, value, converted=None):
+    global pendingSince
+    if converted is None:
+        converted = t2d(attr, value, Devices[idx].Type, Devices[idx].SubType)
+    nValue, sValue = converted
     if nValue != None and sValue != None:
-        if Devices[idx].nValue != nValue or Devices[idx].sValue != sValue or currenttime - lastupdate > timedelta(minutes=59):
-            Debug("tasmota::updateValue: Idx:{}, Attr: {}, nValue: {}, sValue: {}".format(
-                idx, attr, nValue, sValue))
-            Devices[idx].Update(nValue=nValue, sValue=sValue)
+        lastSeen[idx] = time.monotonic()
+        if idx not in keepaliveDue and idx in lastWrites:
+            scheduleKeepalive(idx)
+        written = (Devices[idx].nValue, Devices[idx].sValue)
+        if pendingUpdates.get(idx, written) != (nValue, sValue):
+            if suppressedByDeadBand(idx, attr, value):
+                Debug("tasmota::updateValue: Idx:{}, Attr: {}, sValue: {} within dead-band", idx, attr, sValue)
+                suppressedValues[idx] = (nValue, sValue, bandValue(attr, value))
+                metrics.count('tasmoticz_updates_suppressed_total', 'deadband')
+                return
+            suppressedValues.pop(idx, None)
+            Debug("tasmota::updateValue: Idx:{}, Attr: {}, nValue: {}, sValue: {}",
+                idx, attr, nValue, sValue)
+            if updateDelay <= 0 or attr in powerAttrs:
+                pendingUpdates.pop(idx, None)
+                Devices[idx].Update(nValue=nValue, sValue=sValue)
+                lastWrites[idx] = time.monotonic()
+                metrics.count('tasmoticz_updates_total')
+            else:
+                if not pendingUpdates:
+                    pendingSince = time.monotonic()
+                elif idx in pendingUpdates:
+                    metrics.count('tasmoticz_updates_suppressed_total', 'coalesced')
+                pendingUpdates[idx] = (nValue, sValue)
+        else:
+            # Back at the written value, a keepalive must not write an older suppressed one
+            suppressedValues.pop(idx, None)
+            metrics.count('tasmoticz_updates_suppressed_total', 'unchanged')
+
 
+# Optimistically updated switches: unit -> [deadline, previous and expected (nValue, sValue), topic, msg, retries left]
+unconfirmed = {}
 
-# Update domoticz device values related to tasmota STATE message (POWER*), create device if it does not exist yet
+
+# Confirm an optimistic update by a value reported by the device. A RESULT always confirms (it is the answer)
+# Returns False if the value contradicts the still unconfirmed command, e.g. an older STATE
+def confirmCommand(idx, attr, value, converted=None, result=False):
+    entry = unconfirmed.get(idx)
+    if entry is None:
+        return True
+    if converted is None:
+        converted = t2d(attr, value, Devices[idx].Type, Devices[idx].SubType)
+    if result or converted == entry[2]:
+        del unconfirmed[idx]
+        return True
+    metrics.count('tasmoticz_updates_suppressed_total', 'unconfirmed')
+    return False
+
+
+# Update domoticz device values related to tasmota STATE (POWER*) or SENSOR messages, create device if it does not exist yet
+# values are prepared by prepareValues(), sensor and desc are None for STATE values
 # Returns true if a new device was created
-def updateStateDevices(fullName, cmndName, message):
+def updateDevices(fullName, cmndName, values):
     ret = False
-    idxs = findDevices(fullName)
-    for attr, value in getStateDevices(message):
-        idx = deviceByAttr(idxs, attr)
+    deviceHash = deviceId(fullName)
+    for attr, value, sensor, desc, idx, converted in values:
+        if combineSensors and desc is not None and replacedByCombined(deviceHash, attr, sensor):
+            continue
+        # Prepared idx might be outdated if prepared on a worker thread
+        found = deviceByAttr(deviceHash, attr)
+        if found != idx:
+            idx = found
+            converted = None
         if idx == None:
-            idx = createStateDevice(fullName, cmndName, attr)
+            if desc is None:
+                idx = createStateDevice(fullName, cmndName, attr)
+            else:
+                idx = createSensorDevice(fullName, cmndName, attr, sensor,
+                    dict(desc, Sensor='Energie' if sensor == 'ENERGY' else sensor))
             if idx != None:
                 ret = True
-        if idx != None:
-            updateValue(idx, attr, value)
+        if idx != None and (idx not in unconfirmed or confirmCommand(idx, attr, value, converted)):
+            updateValue(idx, attr, value, converted)
     return ret
 
 
 # Update domoticz device related to tasmota RESULT message (e.g. on power on/off)
 def updateResultDevice(fullName, message):
-    idxs = findDevices(fullName)
     attr, value = next(iter(message.items()))
-    for idx in idxs:
+    idx = deviceByAttr(deviceId(fullName), attr)
+    if idx is not None:
         try:
-            description = json.loads(Devices[idx].Description)
-            if description['Command'] == attr:
-                updateValue(idx, attr, value)
+            confirmCommand(idx, attr, value, result=True)
+            updateValue(idx, attr, value)
         except Exception as e:
             Domoticz.Error("tasmota::updateResultDevice: Update value for idx {} failed: {}".format(idx, str(e)))
 
 
-# Update domoticz device values related to tasmota SENSOR message, create device if it does not exist yet
-# Returns true if a new device was created
-def updateSensorDevices(fullName, cmndName, message):
-    ret = False
-    idxs = findDevices(fullName)
-    #   ENERGY, Voltage, 220 {Name: Spannung, Unit: V}
-    for sensor, type, values, desc in getSensorDevices(message):
-        # Check if sensor reports more than one value (e.g. dual energy meter)
-        if not isinstance(values, list):
-            values = [values]
-        items = len(values)
-        for i, value in enumerate(values):
-            if items > 1:
-                attr = '{}-{}-{}'.format(sensor, i+1, type)
-            else:
-                attr = '{}-{}'.format(sensor, type)
-            idx = deviceByAttr(idxs, attr)
-            if idx == None:
-                idx = createSensorDevice(fullName, cmndName, attr, desc)
-                if idx != None:
-                    ret = True
-            if idx != None:
-                updateValue(idx, attr, value)
-    return ret
-
-
-# Update domoticz device description related to tasmota INFO1 message: Version and Module
+# Update module and version of a device from tasmota INFO1 message (stored once per DeviceID, see deviceInfos)
 def updateInfo1Devices(fullName, cmndName, message):
     try:
         if "Info1" in message:
@@ -502,25 +1509,17 @@ def updateInfo1Devices(fullName, cmndName, message):
             module = message["Module"]
             version = message["Version"]
 
-        for idx in findDevices(fullName):
-            try:
-                description = json.loads(Devices[idx].Description)
-                dirty = False
-                if "Module" not in description or module != description["Module"]:
-                    Domoticz.Log("tasmota::updateInfo1Devices: idx: {}, name: {}, module: {}".format(
-                        idx, Devices[idx].Name, module))
-                    description["Module"] = module
-                    dirty = True
-                if "Version" not in description or version != description["Version"]:
-                    Domoticz.Log("tasmota::updateInfo1Devices: idx: {}, name: {}, version: {}".format(
-                        idx, Devices[idx].Name, version))
-                    description["Version"] = version
-                    dirty = True
-                if dirty:
-                    Devices[idx].Update(nValue=Devices[idx].nValue, sValue=Devices[idx].sValue, 
-                        Description=json.dumps(description, indent=2, ensure_ascii=False), SuppressTriggers=True)
-            except Exception as e:
-                Domoticz.Error("tasmota::updateInfo1Devices: Set module and version for idx {} failed: {}".format(idx, str(e)))
+        deviceHash = deviceId(fullName)
+        if deviceHash not in deviceIndex:
+            return
+        info = {'m': module, 'v': version}
+        if deviceInfos.get(deviceHash) != info:
+            Domoticz.Log("tasmota::updateInfo1Devices: device: {}, module: {}, version: {}".format(
+                fullName, module, version))
+            deviceInfos[deviceHash] = info
+            saveDeviceInfos()
+        if deviceInfosSaved is False:
+            describeDeviceInfo(deviceHash, info)
 
     except Exception as e:
         Domoticz.Error("tasmota::updateInfo1Devices: Get module and version failed: {}".format(str(e)))
@@ -533,13 +1532,12 @@ def updateStatusDevices(fullName, cmndName, message):
 
         for idx in findDevices(fullName):
             try:
-                description = json.loads(Devices[idx].Description) 
+                description = dict(getDescription(idx))
                 command = description["Command"]
-                nonames = ['Sonoff', 'Tasmota', '', None] + ['Tasmota{}'.format(r) for r in range(2, 9)]
                 name = None
                 # check if device is one of several power switches (e.g. power[12] or one of sensors with multiple values (e.g. ENERGY-[12]-Current)
                 for i in range(8):
-                    if len(names) > i and names[i] not in nonames:
+                    if len(names) > i and names[i] not in noNames:
                         if command == "POWER{}".format(i+1):
                             name = names[i]
                             break
@@ -547,7 +1545,7 @@ def updateStatusDevices(fullName, cmndName, message):
                         if len(cmd) > 2 and cmd[-2] == str(i+1): 
                             name = names[i]
                             break
-                if name == None and names[0] not in nonames:
+                if name == None and names[0] not in noNames:
                     # not a multi power switch or multi value sensor: use first friendly name
                     name = names[0]
                 if name is not None and command != 'POWER':
@@ -558,12 +1556,10 @@ def updateStatusDevices(fullName, cmndName, message):
                     Domoticz.Log("tasmota::updateStatusDevices: idx: {}, from: {}, to: {}".format(
                         idx, Devices[idx].Name, name))
                     description["Name"] = name
-                    Devices[idx].Update(
-                        nValue=Devices[idx].nValue, sValue=Devices[idx].sValue, Name=name, 
-                        Description=json.dumps(description, indent=2, ensure_ascii=False), SuppressTriggers=True)
+                    updateDescription(idx, description, Name=name)
                 else:
-                    Debug("tasmota::updateStatusDevices: idx: {}, rename: {}, skipped: {}".format(
-                        idx, Devices[idx].Name, repr(names)))
+                    Debug("tasmota::updateStatusDevices: idx: {}, rename: {}, skipped: {!r}",
+                        idx, Devices[idx].Name, names)
             except Exception as e:
                 Domoticz.Error("tasmota::updateStatusDevices: Set friendly name for idx {} failed: {}".format(idx, str(e)))
 
@@ -588,5 +1584,6 @@ def updateEnergyDevices(fullName, cmndName, message):
 # color control
 # UI translations
 # send RSSI on updates, RSSI as sensor value
-# combined tasmota sensor values (temp/humi/baro, ...)
 # respect units configured in tasmota (°C vs F, ...) 
+# migrate to the extended plugin framework (DomoticzEx): one domoticz device per tasmota DeviceID with its units,
+#   lifts the limit of 511 units (maxUnit) per plugin instance
@@ -0,0 +1,104 @@
+# Lazy debug tracing for all plugin modules
+#
+# Debug = Tracer('tasmota')
+# Debug("Handler::onMQTTPublish: topic: {}", topic)
+#
+# Arguments are only formatted if a trace is logged or dumped, so disabled tracing costs a function call.
+# Traces can be sampled (only every Nth mqtt message is traced) and recorded in a ring buffer of the
+# last K traces that can be dumped on demand, so tracing can stay enabled under load.
+# Traces of worker threads are logged by flush() on the plugin thread.
+
+
+import threading
+import time
+from collections import deque
+
+try:
+    import Domoticz
+except ImportError:
+    Domoticz = None
+
+
+# Trace every sampleRate'th message (see sampleMessage()). Sampling decision is per thread
+sampleRate = 1
+sampleCount = 0
+local = threading.local()
+local.sampled = True
+
+# Traces of worker threads waiting for flush()
+mainThread = threading.main_thread()
+deferred = deque()
+
+# Last traces as (time, tracer name, format, args), formatted on dump(). None if not recording
+ring = None
+
+# Tracer name -> Tracer
+tracers = {}
+
+
+# Configure sampling of messages and the size of the ring buffer (0 disables recording)
+def configure(rate=1, size=0):
+    global sampleRate, ring
+    sampleRate = max(int(rate), 1)
+    ring = deque(maxlen=int(size)) if size > 0 else None
+
+
+# Switch logging of a module's traces to domoticz debug on or off
+def setEnabled(name, flag):
+    tracers[name].enabled = flag
+
+
+# Called when processing of an mqtt message starts: decides if its traces are sampled
+def sampleMessage():
+    global sampleCount
+    sampleCount += 1
+    local.sampled = sampleCount >= sampleRate
+    if local.sampled:
+        sampleCount = 0
+
+
+# Called when processing of an mqtt message is done: trace everything else again
+def sampleAll():
+    local.sampled = True
+
+
+# Log traces of worker threads to domoticz debug. Called on the plugin thread
+def flush():
+    while deferred:
+        Domoticz.Debug(deferred.popleft())
+
+
+def _format(fmt, args):
+    try:
+        return fmt.format(*args) if args else fmt
+    except Exception as e:
+        return '{} {!r} (format error: {})'.format(fmt, args, e)
+
+
+# Write the recorded traces to a file, oldest first. Returns the number of traces written
+def dump(path):
+    traces = list(ring) if ring is not None else []
+    with open(path, 'w', encoding='utf8') as f:
+        for when, name, fmt, args in traces:
+            f.write('{}.{:03d} {}: {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)),
+                                                int(when * 1000) % 1000, name, _format(fmt, args)))
+    return len(traces)
+
+
+class Tracer:
+    def __init__(self, name, enabled=False):
+        self.name = name
+        self.enabled = enabled
+        tracers[name] = self
+
+    # Log to domoticz debug if enabled and record in the ring buffer if configured
+    def __call__(self, fmt, *args):
+        if not (self.enabled or ring is not None) or not getattr(local, 'sampled', True):
+            return
+        if ring is not None:
+            ring.append((time.time(), self.name, fmt, args))
+        if self.enabled and Domoticz is not None:
+            if threading.current_thread() is mainThread:
+                Domoticz.Debug(_format(fmt, args))
+            else:
+                deferred.append(_format(fmt, args))